@@ -37,23 +37,109 @@
 # This application supports stream, messages, etc
 
 # -*- coding: utf-8 -*-
+import datetime
 import os
+import re
+import jwt
 from eve.auth import TokenAuth
 from eve import Eve
-from flask import abort
-from pymongo import MongoClient
+from flask import abort, jsonify
 from bson import ObjectId
 # app
-from api.hooks import (users_hooks, before_returning_items_from_me,
+from api.hooks import (users_hooks,
 		before_on_insert_issue, before_get_comments_hashtags,
-		before_on_insert_comments, post_post_comments_new, before_on_insert_users,
-		after_inserted_stars_user, on_post_get_issues_with_grouped,
-		before_get_comments_search, before_get_users_search
+		before_on_insert_comments, before_render_POST_comments_user,
+		before_on_insert_users,
+		after_inserted_stars_user, after_fetched_issues_grouped,
+		before_get_comments_search, before_get_users_search,
+		after_updated_me, after_deleted_item_users, before_deleted_users,
+		after_deleted_users, after_inserted_issues, after_updated_issues,
+		after_deleted_item_issues, before_on_update_comments,
+		before_get_comments_after, after_fetched_comments,
+		after_inserted_comments, after_updated_comments,
+		after_deleted_item_comments, before_get_trending,
+		before_on_update_me, before_get_users_autocomplete,
+		after_fetched_issue_stats, before_get_leaders, grouped_issues_matches
 	)
+from api import cache, mongo, views
+from api.catalog import IssueCatalog
+from api.data import ApiMongo
+from api.encoders import ApiJSONEncoder
+from api.utils import decode_token, schema_regexes
 import settings
 
-conn = MongoClient()
-database = conn[settings.MONGO_DBNAME]
+# The client of the app, created at first use in each process (see mongo.py).
+# Eve's data layer uses the same one.
+database = mongo.LazyDatabase(mongo.pool)
+cache.register('mongo_pool', mongo.pool)
+
+# Successful password verifications by (email, password hash). See
+# resources.ApiBasicAuth.check_password.
+login_cache = cache.TTLCache('login', settings.LOGIN_CACHE_SIZE,
+							settings.LOGIN_CACHE_TTL)
+
+def load_revoked_subjects():
+	lookup = {'expires_at': {'$gt': datetime.datetime.utcnow()}}
+	return [r['sub'] for r in database.revoked_tokens.find(lookup, {'sub': 1})]
+
+def load_cache_version(name):
+	""" The version of a VersionedCache and its last changes (see
+	hooks.bump_cache_version).
+	"""
+	version = database.cache_versions.find_one({'_id': name})
+	if not version:
+		return 0, []
+	return version.get('version', 0), version.get('changes', [])
+
+# Resolved accounts by (token, allowed_roles). See ApiTokenAuth.check_auth. The
+# users hooks drop the accounts of the users they change (see
+# hooks.invalidate_token_cache).
+token_cache = cache.VersionedCache('token_auth',
+								lambda: load_cache_version('token_auth'),
+								settings.TOKEN_AUTH_CACHE_SIZE,
+								settings.TOKEN_AUTH_CACHE_TTL,
+								settings.TOKEN_AUTH_CACHE_SYNC,
+								lambda user_id, key, account: account['_id'] == user_id)
+
+# `_grouped` of GET /issues?grouped=1 by filter and page. The issues hooks
+# drop the filters that can match the units of the issues they write (see
+# hooks.invalidate_grouped_issues).
+grouped_issues_cache = cache.VersionedCache('issues_grouped',
+								lambda: load_cache_version('issues_grouped'),
+								settings.GROUPED_ISSUES_CACHE_SIZE,
+								settings.GROUPED_ISSUES_CACHE_TTL,
+								settings.GROUPED_ISSUES_CACHE_SYNC,
+								grouped_issues_matches)
+
+# GET /me documents by user. The user's entry is dropped by PATCH /me and by
+# the logins reissuing the token (see hooks.invalidate_me).
+me_cache = cache.VersionedCache('me', lambda: load_cache_version('me'),
+								settings.ME_CACHE_SIZE, settings.ME_CACHE_TTL,
+								settings.ME_CACHE_SYNC)
+
+# Users whose tokens can't be trusted by claims only (deleted, roles changed).
+revoked_tokens = cache.RevocationSet('revoked_tokens', load_revoked_subjects,
+							settings.TOKEN_REVOCATION_SYNC,
+							settings.TOKEN_REVOCATION_BLOOM_BITS)
+
+def load_catalog_generation():
+	generation = database.cache_versions.find_and_modify({'_id': 'issue_catalog'},
+						{'$setOnInsert': {'generation': ObjectId()}},
+						upsert=True, new=True)
+	return generation['generation'].binary
+
+# register -> issue shared by the workers. See hooks.resolve_issues. A dropped
+# database loses its generation, so the catalog of the old one is emptied.
+issue_catalog = IssueCatalog(settings.ISSUE_CATALOG_PATH,
+								settings.ISSUE_CATALOG_SLOTS,
+								settings.MONGO_DBNAME, load_catalog_generation,
+								settings.ISSUE_CATALOG_SYNC)
+cache.register('issue_catalog', issue_catalog)
+
+class RevokedToken(Exception):
+	""" The subject of the token is in revoked_tokens: its account must be
+	read from the database.
+	"""
 
 class ApiTokenAuth(TokenAuth):
 	def check_auth(self, token, allowed_roles, resource, method):
@@ -63,14 +149,37 @@ class ApiTokenAuth(TokenAuth):
 		Example:
 		token = 'message'
 		signature = base64.b64encode(token + ':')
+
+		With TOKEN_AUTH_STATELESS the signed claims of the token are trusted
+		and the database is only queried when the user is in revoked_tokens
+		or the token was issued before the claims `exp` and `roles` existed.
 		"""
-		accounts = app.data.driver.db['user']
-		lookup = {'token': token}
-		if allowed_roles:
-			# only retrieve a user if his roles match
-			lookup['roles'] = {'$in': allowed_roles}
+		account = None
+		revoked = False
+		if settings.TOKEN_AUTH_STATELESS:
+			try:
+				account = self.account_from_claims(token, allowed_roles)
+			except jwt.ExpiredSignatureError:
+				return False
+			except RevokedToken:
+				# the cached account can be the one before the revocation.
+				revoked = True
+
+		cache_key = (token, tuple(sorted(allowed_roles or [])))
+		if account is None and not revoked:
+			account = token_cache.get(cache_key)
+
+		if account is None:
+			accounts = app.data.driver.db['user']
+			lookup = {'token': token}
+			if allowed_roles:
+				# only retrieve a user if his roles match
+				lookup['roles'] = {'$in': allowed_roles}
+
+			account = accounts.find_one(lookup, {'_id': 1, 'roles': 1}) # Query here
+			if account:
+				token_cache.set(cache_key, account)
 
-		account = accounts.find_one(lookup) # Query here
 		# workaround to block empty [] roles. Temporally implementation.
 		# teorically this not needs.
 		if account and 'roles' in account and len(account['roles']) == 0:
@@ -88,6 +197,27 @@ class ApiTokenAuth(TokenAuth):
 			# iii. password invalid.
 			return False
 
+	def account_from_claims(self, token, allowed_roles):
+		""" Returns the account described by the token claims, `False` if
+		its roles aren't allowed or `None` when the claims can't be trusted and
+		the database must be queried. Raises RevokedToken when the user is in
+		revoked_tokens.
+		"""
+		try:
+			claims = decode_token(token)
+		except jwt.ExpiredSignatureError:
+			raise
+		except jwt.InvalidTokenError:
+			return None
+
+		if revoked_tokens.might_contain(claims['sub']):
+			raise RevokedToken(claims['sub'])
+
+		if allowed_roles and not set(claims['roles']) & set(allowed_roles):
+			return False
+
+		return {'_id': ObjectId(claims['sub']), 'roles': claims['roles']}
+
 # to export EVE_SETTING with path
 # In the terminal:
 # $ export EVE_SETTINGS=/path/to/settings/from/api/settings.py
@@ -96,28 +226,80 @@ if EVE_SETTINGS is None:
 	raise TypeError(u'Environment variable EVE_SETTINGS is not defined.' \
 						'Please to define it.')
 
-app = Eve(auth=ApiTokenAuth, settings=EVE_SETTINGS)
+app = Eve(auth=ApiTokenAuth, settings=EVE_SETTINGS, data=ApiMongo,
+			json_encoder=ApiJSONEncoder)
+# GET /me without Eve's collection GET (see views.get_me).
+views.init_app(app)
 
 #################### Adding hooks #####################
 # hooks on_fetched_resource_me HTTP events
 #app.on_pre_GET_me += users_hooks['get_authenticated']
 app.on_pre_GET_comments += before_get_comments_hashtags
 app.on_pre_GET_comments += before_get_comments_search
+app.on_pre_GET_comments += before_get_comments_after
 app.on_pre_GET_users += before_get_users_search
+app.on_pre_GET_users_autocomplete += before_get_users_autocomplete
+app.on_pre_GET_trending += before_get_trending
+app.on_pre_GET_comment_leaders += before_get_leaders
+app.on_pre_GET_author_leaders += before_get_leaders
 app.on_pre_POST_users += users_hooks['set_username']
-app.on_post_POST_users += users_hooks['set_owner']
-app.on_post_POST_comments_user += post_post_comments_new
+app.on_render_POST_comments_user += before_render_POST_comments_user
 
-# test this implementation:
-app.on_post_GET_issues += on_post_get_issues_with_grouped
 
 # hooks on database events
-app.on_fetched_resource_me += before_returning_items_from_me
-# app.on_fetched_resource_comments += after_fetched_comments
+app.on_fetched_resource_comments += after_fetched_comments
+app.on_fetched_resource_issues += after_fetched_issues_grouped
+app.on_fetched_resource_issue_stats += after_fetched_issue_stats
 app.on_insert_issues += before_on_insert_issue
 app.on_insert_comments_user += before_on_insert_comments # pre
+app.on_update_comments_user_edit += before_on_update_comments
+# keeps the hashtag_stats (trending) of the comments.
+app.on_inserted_comments_user += after_inserted_comments
+app.on_updated_comments_user_edit += after_updated_comments
+app.on_deleted_item_comments_user_edit += after_deleted_item_comments
+# keeps the issue_catalog coherent with the issue collection.
+app.on_inserted_issues += after_inserted_issues
+app.on_inserted_issues_super += after_inserted_issues
+app.on_updated_issues += after_updated_issues
+app.on_updated_issues_super += after_updated_issues
+app.on_deleted_item_issues += after_deleted_item_issues
 app.on_insert_users += before_on_insert_users
+app.on_update_me += before_on_update_me
 app.on_inserted_stars_user += after_inserted_stars_user
+# keeps the token_cache coherent with the user collection.
+app.on_updated_me += after_updated_me
+app.on_deleted_item_users += after_deleted_item_users
+app.on_delete_resource_users += before_deleted_users
+app.on_deleted_resource_users += after_deleted_users
+
+#################### Warm-up #####################
+def warmup():
+	""" Readies a new worker before its first request (see GunicornServer in
+	manage.py): creates its MongoDB client, sorts the URL rules, compiles the
+	`regex` rules of the schemas and loads the cache versions, the revoked
+	tokens and the issue catalog. Everything here would otherwise be done by
+	the first requests.
+	"""
+	database.command('ping')
+	app.url_map.update()
+	# Cerberus compiles them at each validation, then they come from re's cache.
+	for resource in app.config['DOMAIN'].values():
+		for pattern in schema_regexes(resource['schema']):
+			re.compile(pattern)
+	grouped_issues_cache.sync()
+	me_cache.sync()
+	revoked_tokens.reload()
+	issue_catalog.open()
+
+#################### Runtime stats #####################
+@app.route('%s/_stats' % app.api_prefix)
+def runtime_stats():
+	""" Counters of the in-process caches for this worker. Only superusers
+	can read them.
+	"""
+	if not app.auth.authorized(['superusers'], None, 'GET'):
+		return app.auth.authenticate()
+	return jsonify({'pid': os.getpid(), 'caches': cache.stats()})
 
 if __name__ == '__main__':
 	app.run(threaded=True)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+ Benchmarks.py
+
+ Latency benchmarks of the hot paths. They run in-process (test_client) against
+ the database of the EVE_SETTINGS, so point it to a scratch database:
+
+ $ export EVE_SETTINGS=`pwd`/api/settings.py
+ $ python -m api.benchmarks            # runs all
+ $ python -m api.benchmarks bulk_comments
+"""
+
+import base64
+import datetime
+import json
+import re
+import sys
+import time
+from bson import ObjectId
+# app
+import api
+from api import hooks
+from eve.io.mongo.mongo import MongoJSONEncoder
+from api.encoders import ApiJSONEncoder, ujson
+from api.utils import (generate_token, render_markup, to_link_hashtag,
+                       JSONEncoder)
+
+
+def timed(func, repeat=5):
+    """ Runs `func` `repeat` times and returns (best, median) in ms. """
+    samples = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        samples.append((time.time() - start) * 1000)
+    samples.sort()
+    return samples[0], samples[len(samples) // 2]
+
+def report(title, rows, label='items'):
+    print title
+    print '%10s %12s %12s %12s %12s' % (label, 'before best', 'before med',
+                                        'after best', 'after med')
+    for size, before, after in rows:
+        print '%10d %12.2f %12.2f %12.2f %12.2f' % ((size,) + before + after)
+    print
+
+def create_user(roles=('users',)):
+    db = api.database
+    user_id = ObjectId()
+    token = generate_token(user_id, list(roles))
+    db.user.insert({'_id': user_id, 'email': 'bench_%s@bench.com' % user_id,
+                    'roles': list(roles), 'token': token, 'owner': user_id})
+    headers = {'Authorization': 'Basic %s' % base64.b64encode(token + ':')}
+    return user_id, headers
+
+# Hashtag links before render_markup: a second scan of the body, after the
+# re.findall of the hashtags.
+def legacy_wrap_hashtags(pattern, content):
+    return re.sub(pattern, lambda m: to_link_hashtag(m.group(0)), content)
+
+# Resolution of the issues before the batched resolve_issues, one query per
+# comment. It sets `hashtags_norm` as the current hook does, so both timings
+# write the same documents.
+def legacy_before_on_insert_comments(items):
+    preg = r'(#\w+)'
+    for item in items:
+        item['hashtags'] = re.findall(preg, item['body'])
+        item['hashtags_norm'] = hooks.unique_hashtags_norm(item['hashtags'])
+        item['body'] = legacy_wrap_hashtags(preg, item['body'])
+
+        if 'issue' not in item and 'register' in item and item['register']:
+            issue = api.database.issue.find_one({'register': item['register']})
+            item['issue'] = issue['_id']
+        elif 'issue' in item and 'register' not in item:
+            issue = api.database.issue.find_one({'_id': item['issue']})
+        else:
+            issue = None
+
+        if issue:
+            item['title'] = issue['title']
+        elif len(item['hashtags']) > 0:
+            item['title'] = item['hashtags'][0]
+        else:
+            item['title'] = 'no subject'
+
+        if 'issue' in item and item['issue']:
+            deltatime = datetime.datetime.utcnow() - issue['created_at']
+            item['shottime'] = str(int(deltatime.total_seconds() / 60))
+        else:
+            item['shottime'] = str(datetime.datetime.today().hour) + 'h'
+
+def bench_bulk_comments(sizes=(1, 10, 100, 1000)):
+    """ POST /comments/new with bulks of comments referencing issues, half
+    by register and half by _id.
+    """
+    app = api.app
+    db = api.database
+    client = app.test_client()
+    user_id, headers = create_user()
+    now = datetime.datetime.utcnow()
+    issues = [{'_id': ObjectId(), 'register': 'BENCH%06d' % i,
+               'title': 'BENCH %d' % i, 'body': 'bench', 'ugat': 'BENCH',
+               'ugser': 'BENCH', 'created_at': now, 'updated_at': now}
+              for i in range(max(sizes))]
+    db.issue.insert(issues)
+
+    def post(size):
+        comments = []
+        for i, issue in enumerate(issues[:size]):
+            comment = {'body': 'Bench comment #bench %d' % i}
+            if i % 2:
+                comment['register'] = issue['register']
+            else:
+                comment['issue'] = str(issue['_id'])
+            comments.append(comment)
+        data = json.dumps(comments)
+        def run():
+            r = client.post(app.api_prefix + '/comments/new', data=data,
+                            headers=headers,
+                            content_type='application/json')
+            assert r.status_code == 201, r.data
+        return run
+
+    rows = []
+    try:
+        for size in sizes:
+            app.on_insert_comments_user -= hooks.before_on_insert_comments
+            app.on_insert_comments_user += legacy_before_on_insert_comments
+            try:
+                before = timed(post(size))
+            finally:
+                app.on_insert_comments_user -= legacy_before_on_insert_comments
+                app.on_insert_comments_user += hooks.before_on_insert_comments
+            after = timed(post(size))
+            rows.append((size, before, after))
+    finally:
+        db.comment.remove({'author': user_id})
+        db.issue.remove({'_id': {'$in': [i['_id'] for i in issues]}})
+        db.user.remove({'_id': user_id})
+
+    report('Bulk POST comments/new (ms per request)', rows)
+
+def bench_markup(sizes=(1000, 10000, 100000, 1000000)):
+    """ Rendering of large comment bodies: `re.findall` plus a second scan
+    wrapping the hashtags (before) and the single scan of `render_markup`.
+    """
+    words = u'Lentidão no #SISCOMEX reportada por @fulano em 2015RI/0001 ' \
+            u'contato fulano@serpro.gov.br #Rede'.split()
+    rows = []
+    for size in sizes:
+        body = u''
+        while len(body) < size:
+            body += u' '.join(words) + u' '
+        def before():
+            re.findall(r'(#\w+)', body)
+            legacy_wrap_hashtags(r'(#\w+)', body)
+        def after():
+            render_markup(body)
+        rows.append((len(body), timed(before), timed(after)))
+
+    report('Comment body markup (ms per body)', rows, label='chars')
+
+def bench_render(sizes=(25, 250, 2500)):
+    """ Serialization of comment pages: encoded, decoded and encoded again by a
+    post hook (before) and encoded once, after the render hooks edited the
+    payload, by each JSON_BACKEND (after).
+    """
+    app = api.app
+    now = datetime.datetime.utcnow()
+    backends = ['simplejson', 'json'] + (['ujson'] if ujson else [])
+    rows = dict((name, []) for name in backends)
+    for size in sizes:
+        payload = {
+            '_items': [{'_id': ObjectId(), 'author': ObjectId(),
+                        'issue': ObjectId(), 'title': u'BENCH %d' % i,
+                        'body': u'Lentidão no <a href="#">#SISCOMEX</a> %d' % i,
+                        'hashtags': [u'#SISCOMEX'], 'shottime': '42',
+                        'created_at': now, 'updated_at': now, '_etag': 'x' * 40,
+                        '_links': {'self': {'title': 'Comment',
+                                            'href': 'comments/%d' % i}}}
+                       for i in range(size)],
+            '_links': {'self': {'title': 'comments', 'href': 'comments'}},
+            '_meta': {'page': 1, 'max_results': size, 'total': size}
+        }
+        def before():
+            data = json.loads(MongoJSONEncoder().encode(payload))
+            JSONEncoder().encode(data)
+        with app.test_request_context():
+            for name in backends:
+                app.config['JSON_BACKEND'] = name
+                try:
+                    rows[name].append((size, timed(before),
+                                       timed(lambda: ApiJSONEncoder().encode(payload))))
+                finally:
+                    app.config['JSON_BACKEND'] = 'auto'
+
+    for name in backends:
+        report('Comment pages, %s (ms per page)' % name, rows[name])
+
+
+BENCHMARKS = {
+    'bulk_comments': bench_bulk_comments,
+    'markup': bench_markup,
+    'render': bench_render,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
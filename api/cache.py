@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+# In-process caches used by the hot paths of the API (authentication, etc).
+# Each gunicorn worker keeps its own copy. Every cache registers itself by
+# name so its counters can be read at the `_stats` endpoint.
+
+import hashlib
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+
+_registry = OrderedDict()
+
+
+class TTLCache(object):
+    """ Bounded LRU cache whose entries also expire after `ttl` seconds.
+
+    :param name: name used to expose the counters (see `stats`).
+    :param maxsize: max number of entries. The least recently used is dropped.
+    :param ttl: seconds an entry lives. `None` or `0` means no expiration.
+    """
+
+    def __init__(self, name, maxsize=1024, ttl=60):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        _registry[name] = self
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                expires, value = entry
+                if not expires or expires > time.time():
+                    # re-insert to mark as the most recently used.
+                    self._data[key] = entry
+                    self.hits += 1
+                    return value
+                self.evictions += 1
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def delete_where(self, predicate):
+        """ Removes every entry whose `(key, value)` matches the predicate.
+        It's O(n), use it only on writes (which are rare compared to reads).
+        """
+        with self._lock:
+            keys = [k for k, (_, v) in self._data.items() if predicate(k, v)]
+            for key in keys:
+                del self._data[key]
+            self.invalidations += len(keys)
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._data)
+            self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(float(self.hits) / lookups, 4) if lookups else None,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+class VersionedCache(TTLCache):
+    """ TTLCache invalidated in every process through a version number kept
+    out of them (e.g. a counter in the database). Each write increments the
+    version and records what it changed (e.g. the user), so only the entries
+    depending on it are dropped. The version and the last changes are read by
+    `loader` at most once per `interval` seconds, so other processes see a
+    write after `interval` seconds at most. All the entries are dropped when a
+    change is `None` (everything changed) or some changes since the last read
+    weren't kept.
+
+    :param loader: callable returning the current version and the last
+                   changes, the oldest first.
+    :param interval: seconds between two reads of the version.
+    :param matches: `matches(change, key, value)`, whether an entry depends
+                    on a change. By default the change is the entry's key.
+    """
+
+    def __init__(self, name, loader, maxsize=1024, ttl=60, interval=1,
+                 matches=None):
+        super(VersionedCache, self).__init__(name, maxsize, ttl)
+        self.loader = loader
+        self.interval = interval
+        self.matches = matches
+        self.version = None
+        self.syncs = 0
+        self._synced_at = 0
+
+    def sync(self):
+        if time.time() - self._synced_at <= self.interval:
+            return
+        version, changes = self.loader()
+        self.syncs += 1
+        self._synced_at = time.time()
+        if version != self.version:
+            new = version - self.version if self.version is not None else 0
+            if 0 < new <= len(changes):
+                for change in changes[-new:]:
+                    self.invalidate(change)
+            else:
+                self.clear()
+            self.version = version
+
+    def invalidate(self, change):
+        """ Drops the entries of this process depending on `change`. """
+        if change is None:
+            self.clear()
+        elif self.matches is None:
+            self.delete(change)
+        else:
+            self.delete_where(lambda key, value: self.matches(change, key,
+                                                              value))
+
+    def get(self, key, default=None):
+        self.sync()
+        return super(VersionedCache, self).get(key, default)
+
+    def stats(self):
+        stats = super(VersionedCache, self).stats()
+        stats.update(version=self.version, interval=self.interval,
+                     syncs=self.syncs)
+        return stats
+
+
+class BloomFilter(object):
+    """ Compact set with false positives (never false negatives).
+
+    :param bits: size of the bit array.
+    :param hashes: number of bit positions set per key.
+    """
+
+    def __init__(self, bits=65536, hashes=4):
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray((bits + 7) // 8)
+
+    def _positions(self, key):
+        # double hashing: h1 + i * h2 derived from one sha1 digest.
+        digest = hashlib.sha1(key.encode('utf-8')).digest()
+        h1, h2 = struct.unpack('<II', digest[:8])
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self._array[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self._array[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(key))
+
+
+class RevocationSet(object):
+    """ In-memory view of the revoked token subjects. It's rebuilt from the
+    `loader` (the database) at most once per `interval` seconds, so the check
+    in the request path costs no query.
+
+    :param name: name used to expose the counters (see `stats`).
+    :param loader: callable returning the revoked subjects.
+    :param interval: seconds between two reloads.
+    :param bits: size of the bloom filter.
+    """
+
+    def __init__(self, name, loader, interval=5, bits=65536):
+        self.name = name
+        self.loader = loader
+        self.interval = interval
+        self.bits = bits
+        self.size = 0
+        self.reloads = 0
+        self.checks = 0
+        self.positives = 0
+        self._filter = BloomFilter(bits)
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+        _registry[name] = self
+
+    def reload(self):
+        bloom = BloomFilter(self.bits)
+        size = 0
+        for subject in self.loader():
+            bloom.add(subject)
+            size += 1
+        with self._lock:
+            self._filter = bloom
+            self.size = size
+            self.reloads += 1
+            self._loaded_at = time.time()
+
+    def add(self, subject):
+        """ Revokes locally until the next reload brings it from the loader. """
+        with self._lock:
+            self._filter.add(subject)
+            self.size += 1
+
+    def might_contain(self, subject):
+        """ `False` means certainly not revoked. `True` means the caller must
+        check it against the database.
+        """
+        if time.time() - self._loaded_at > self.interval:
+            self.reload()
+        self.checks += 1
+        found = subject in self._filter
+        if found:
+            self.positives += 1
+        return found
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'bits': self.bits,
+            'interval': self.interval,
+            'reloads': self.reloads,
+            'checks': self.checks,
+            'positives': self.positives,
+        }
+
+
+def register(name, obj):
+    """ Exposes the `stats()` of any other object (e.g. the issue catalog). """
+    _registry[name] = obj
+
+def stats():
+    """ Returns the counters of all objects registered in this process. """
+    return dict((name, cache.stats()) for name, cache in _registry.items())
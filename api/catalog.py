@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+# Issue catalog shared by all workers of the host. It maps a register to the
+# issue's `_id`, `title` and `created_at`, which are what the comments need
+# when inserted (see hooks.resolve_issues). It's a hash table of fixed size
+# slots in a memory-mapped file:
+#
+#  header | slot 0 | slot 1 | ... | slot N-1
+#
+# Writers (the issue hooks) hold a flock on the file. Readers don't lock: each
+# slot has a sequence number that is odd while it's being written, so a reader
+# retries when it changes under it (seqlock).
+#
+# The header has the database and its catalog generation (see `generation`).
+# A file of another database or generation (dropped, restored or reset with
+# `manage.py resetcatalog`) is emptied.
+
+import calendar
+import datetime
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import time
+import zlib
+from bson import ObjectId
+
+
+MAGIC = 'SCIC'
+VERSION = 2
+# magic, version, slots, md5 of the database name, generation.
+HEADER = struct.Struct('<4sII16s12s')
+HEADER_SIZE = 64
+# seq, state, register length, title length, _id, created_at (ms), register,
+# title (utf-8).
+SLOT = struct.Struct('<IBBH12sq52s304s')
+SEQ = struct.Struct('<I')
+EMPTY, USED, DELETED = 0, 1, 2
+MAX_PROBES = 32
+MAX_READ_RETRIES = 8
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class IssueCatalog(object):
+    """ Memory-mapped register -> (_id, title, created_at) catalog.
+
+    :param path: file shared by the workers. `None` disables the catalog. Its
+                 directory is created (0700) when missing.
+    :param slots: number of slots. Registers that don't fit (full table or
+                  too long values) are simply not cataloged.
+    :param database: name of the database of the issues.
+    :param generation: callable returning the 12 bytes generation of the
+                       database's catalog.
+    :param interval: seconds between two reads of the generation.
+    """
+
+    def __init__(self, path, slots=32768, database='', generation=None,
+                 interval=60):
+        self.path = path
+        self.slots = slots
+        self.database = database
+        self.generation = generation
+        self.interval = interval
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.resets = 0
+        self._fd = None
+        self._map = None
+        self._pid = None
+        self._synced_at = 0
+
+    def _open(self):
+        """ Maps the file once per process. The descriptor isn't shared with
+        the parent because flock is per open file.
+        """
+        if self._pid == os.getpid():
+            if self._map is not None:
+                self._sync()
+            return self._map is not None
+        self._pid = os.getpid()
+        self._map = None
+        if not self.path:
+            return False
+
+        size = HEADER_SIZE + self.slots * SLOT.size
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory, 0700)
+            # a symlink planted in place of the file isn't followed.
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW,
+                         0600)
+            os.fchmod(fd, 0600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size != size:
+                    # new file or another layout: starts empty.
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, size)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self._map = mmap.mmap(fd, size, mmap.MAP_SHARED,
+                                  mmap.PROT_READ | mmap.PROT_WRITE)
+            self._fd = fd
+        except (IOError, OSError, mmap.error):
+            # without the catalog every lookup falls back to MongoDB.
+            self._map = None
+            return False
+        self._synced_at = 0
+        self._sync()
+        return True
+
+    def _header(self):
+        database = self.database
+        if isinstance(database, unicode):
+            database = database.encode('utf-8')
+        generation = self.generation() if self.generation else ''
+        return HEADER.pack(MAGIC, VERSION, self.slots,
+                           hashlib.md5(database).digest(), generation)
+
+    def _sync(self):
+        """ Empties the catalog when its header isn't the one of the current
+        database and generation. Checked at most once per `interval` seconds.
+        """
+        if time.time() - self._synced_at <= self.interval:
+            return
+        header = self._header()
+        self._synced_at = time.time()
+        if self._map[:HEADER.size] == header:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if self._map[:HEADER.size] != header:
+                chunk = 1 << 20
+                for offset in range(HEADER_SIZE, len(self._map), chunk):
+                    end = min(offset + chunk, len(self._map))
+                    self._map[offset:end] = '\0' * (end - offset)
+                self._map[:HEADER.size] = header
+                self.resets += 1
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def open(self):
+        """ Maps the file in this process ahead of the first lookup. Returns
+        whether the catalog is enabled.
+        """
+        return self._open()
+
+    def _offsets(self, register):
+        start = (zlib.crc32(register) & 0xffffffff) % self.slots
+        for probe in range(min(MAX_PROBES, self.slots)):
+            yield HEADER_SIZE + ((start + probe) % self.slots) * SLOT.size
+
+    def _read(self, offset):
+        """ Returns a consistent (state, register, issue) of the slot. """
+        for _ in range(MAX_READ_RETRIES):
+            (seq, state, reg_len, title_len, oid, created_at, register,
+                title) = SLOT.unpack_from(self._map, offset)
+            if seq % 2 == 0 and SEQ.unpack_from(self._map, offset)[0] == seq:
+                issue = {
+                    '_id': ObjectId(oid),
+                    'register': register[:reg_len],
+                    'title': title[:title_len].decode('utf-8'),
+                    'created_at': EPOCH + datetime.timedelta(
+                                        milliseconds=created_at)
+                }
+                return state, register[:reg_len], issue
+        return None, None, None
+
+    def _write(self, offset, state, issue=None):
+        seq = SEQ.unpack_from(self._map, offset)[0]
+        SEQ.pack_into(self._map, offset, seq + 1)
+        if issue:
+            register, title = self._encode(issue)
+            created_at = issue['created_at']
+            millis = calendar.timegm(created_at.utctimetuple()) * 1000 + \
+                created_at.microsecond // 1000
+            SLOT.pack_into(self._map, offset, seq + 1, state, len(register),
+                           len(title), issue['_id'].binary, millis,
+                           register, title)
+        else:
+            struct.pack_into('<B', self._map, offset + SEQ.size, state)
+        SEQ.pack_into(self._map, offset, seq + 2)
+        self.writes += 1
+
+    def _encode(self, issue):
+        register = issue['register']
+        if isinstance(register, unicode):
+            register = register.encode('utf-8')
+        title = issue['title'].encode('utf-8')
+        return register, title
+
+    def _fits(self, issue):
+        if not all(issue.get(key) for key in ('_id', 'title', 'created_at')):
+            return False
+        register, title = self._encode(issue)
+        return len(register) <= 52 and len(title) <= 304
+
+    def get(self, register):
+        """ Returns the issue or `None` when the register isn't cataloged. """
+        if not self._open():
+            return None
+        register = register.encode('utf-8') \
+            if isinstance(register, unicode) else register
+        for offset in self._offsets(register):
+            state, slot_register, issue = self._read(offset)
+            if state == EMPTY:
+                break
+            if state == USED and slot_register == register:
+                self.hits += 1
+                return issue
+        self.misses += 1
+        return None
+
+    def put(self, issue):
+        """ Catalogs (or refreshes) the issue. It needs `_id`, `register`,
+        `title` and `created_at`.
+        """
+        if not self._open():
+            return
+        if not self._fits(issue):
+            self.delete(issue['register'])
+            return
+        register, _ = self._encode(issue)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            free = None
+            for offset in self._offsets(register):
+                state, slot_register, _ = self._read(offset)
+                if state == USED and slot_register == register:
+                    free = offset
+                    break
+                if state != USED and free is None:
+                    free = offset
+                if state == EMPTY:
+                    break
+            if free is not None:
+                self._write(free, USED, issue)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def delete(self, register):
+        if not self._open():
+            return
+        register = register.encode('utf-8') \
+            if isinstance(register, unicode) else register
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            for offset in self._offsets(register):
+                state, slot_register, _ = self._read(offset)
+                if state == EMPTY:
+                    break
+                if state == USED and slot_register == register:
+                    self._write(offset, DELETED)
+                    break
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'path': self.path,
+            'slots': self.slots,
+            'enabled': self._map is not None,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(float(self.hits) / lookups, 4) if lookups else None,
+            'writes': self.writes,
+            'resets': self.resets,
+        }
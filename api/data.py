@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+# Data layer of the API. It's Eve's Mongo layer plus the behaviors configured
+# per resource in the DOMAIN (see resources.py).
+
+import json
+from bson import json_util
+from eve.io.mongo import Mongo
+from eve.methods.common import (field_definition, resolve_embedded_fields,
+                                subdocuments)
+from eve.utils import config
+from flask import g, request
+# app
+from api import cache, mongo
+
+
+COUNT_MODES = ('exact', 'cached', 'estimated', 'none')
+
+
+class CountingCursor(object):
+    """ Wraps the pymongo cursor returned to Eve's GET to compute the
+    `_meta.total` according to the resource's `pagination_count`:
+
+    - exact: `count()` with the request's filter.
+    - cached: the exact count kept `PAGINATION_COUNT_CACHE_TTL` seconds by
+      filter.
+    - estimated: the collection's size from its metadata. Only for unfiltered
+      listings, the filtered ones are `cached`.
+    - none: no total. It only looks one document ahead of the page to know
+      if there's a next one.
+
+    The requests continuing a keyset cursor (the resource's
+    `pagination_cursor` argument) are always `none`: the cursor changes the
+    filter at each page, so the cache would never hit, and the total of a
+    cursor's page is meaningless.
+
+    The mode used is returned in `_meta.total_mode`.
+    """
+
+    def __init__(self, cursor, mode, count_cache, prefetch=None):
+        self.cursor = cursor
+        self.mode = mode
+        self.count_cache = count_cache
+        self.prefetch = prefetch
+
+    def __iter__(self):
+        if self.prefetch is None:
+            return iter(self.cursor)
+        # the page is read at once to embed its references in batch.
+        documents = list(self.cursor)
+        self.prefetch(documents)
+        return iter(documents)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    @property
+    def spec(self):
+        # pymongo 2.x keeps the filter of a cursor private.
+        return self.cursor._Cursor__spec
+
+    def count(self, with_limit_and_skip=False):
+        if with_limit_and_skip:
+            return self.cursor.count(True)
+
+        if self.mode == 'estimated':
+            if not self.spec:
+                return self.cursor.collection.count()
+            self.mode = 'cached'
+
+        if self.mode == 'cached':
+            key = (self.cursor.collection.name,
+                   json_util.dumps(self.spec, sort_keys=True))
+            total = self.count_cache.get(key)
+            if total is None:
+                total = self.cursor.count()
+                self.count_cache.set(key, total)
+            return total
+
+        if self.mode == 'none':
+            skip = self.cursor._Cursor__skip
+            limit = self.cursor._Cursor__limit
+            lookahead = self.cursor.clone().limit(limit + 1 if limit else 0)
+            return skip + lookahead.count(True)
+
+        return self.cursor.count()
+
+    def extra(self, response):
+        """ Called by Eve's GET after the hooks. """
+        meta = response.get(config.META)
+        if meta is not None:
+            meta['total_mode'] = self.mode
+            if self.mode == 'none':
+                meta.pop('total', None)
+        if self.mode == 'none':
+            response.get(config.LINKS, {}).pop('last', None)
+
+
+class ApiMongo(Mongo):
+    """ Mongo data layer with the per resource `pagination_count` (see
+    CountingCursor) and `results_limit`, the most documents a GET returns
+    (for the resources without pagination).
+
+    It also embeds the references of the GETs in batch. Eve embeds each
+    reference with its own `find_one`, so the page's references are fetched
+    before with one `$in` query per relation (and `embedded_projection` of
+    the related resource) and those `find_one` are answered from the request.
+    References of the embedded documents are embedded too, e.g.
+    `embedded={"stars.voter":1}` of the comments.
+    """
+
+    def init_app(self, app):
+        # the client shared with the hooks instead of flask_pymongo's.
+        mongo.pool.init_app(app)
+        self.driver = mongo.pool
+        self.count_cache = cache.TTLCache('pagination_count',
+                                          app.config['PAGINATION_COUNT_CACHE_SIZE'],
+                                          app.config['PAGINATION_COUNT_CACHE_TTL'])
+
+    def find(self, resource, req, sub_resource_lookup):
+        cursor = super(ApiMongo, self).find(resource, req, sub_resource_lookup)
+        mode = config.DOMAIN[resource].get('pagination_count',
+                                           config.PAGINATION_COUNT)
+        if mode not in COUNT_MODES:
+            raise ValueError('Invalid pagination_count %r of %s' % (mode,
+                                                                   resource))
+        cursor_arg = config.DOMAIN[resource].get('pagination_cursor')
+        if cursor_arg and request.args.get(cursor_arg):
+            mode = 'none'
+        # the hooks can query with the same filters (see request_spec).
+        if not hasattr(g, 'find_specs'):
+            g.find_specs = {}
+        g.find_specs[resource] = cursor._Cursor__spec
+        limit = config.DOMAIN[resource].get('results_limit')
+        if limit:
+            cursor.limit(min(req.max_results or limit, limit))
+        prefetch = None
+        if any(self.embedded_fields(resource, req)):
+            prefetch = lambda documents: self.embed(resource, req, documents)
+        return CountingCursor(cursor, mode, self.count_cache, prefetch)
+
+    def find_one(self, resource, req, **lookup):
+        ref = lookup.get(config.ID_FIELD)
+        if req is None and lookup.keys() == [config.ID_FIELD] and \
+                not isinstance(ref, (dict, list)):
+            # Eve embedding a reference (eve.methods.common.embedded_document).
+            fetched = getattr(g, 'embedded', {})
+            if (resource, ref) in fetched:
+                document = fetched[(resource, ref)]
+                return dict(document) if document else document
+
+        document = super(ApiMongo, self).find_one(resource, req, **lookup)
+        if document and req is not None and request.method in ('GET', 'HEAD'):
+            self.embed(resource, req, [document])
+        return document
+
+    def embedded_fields(self, resource, req):
+        """ Returns the fields of `resource` embedded by Eve and the
+        (field, subfield) embedded here, e.g. ('stars', 'voter').
+        """
+        fields = resolve_embedded_fields(resource, req)
+        requested = list(config.DOMAIN[resource]['embedded_fields'])
+        if req.embedded:
+            # resolve_embedded_fields already refused the bad clauses.
+            requested += [k for k, v in json.loads(req.embedded).items()
+                          if v == 1]
+
+        nested = []
+        for name in set(requested) - set(fields):
+            field, _, subfield = name.partition('.')
+            relation = self.relation(resource, field)
+            if relation and '.' not in subfield and \
+                    self.relation(relation['resource'], subfield):
+                nested.append((field, subfield))
+        return fields, nested
+
+    def relation(self, resource, field):
+        """ The embeddable `data_relation` of the field or None. """
+        definition = field_definition(resource, field) if field else None
+        relation = (definition or {}).get('data_relation', {})
+        if relation.get('embeddable') and not relation.get('version'):
+            return relation
+
+    def embed(self, resource, req, documents):
+        """ Fetches the references of `documents` to be embedded. """
+        fields, nested = self.embedded_fields(resource, req)
+        for field in set(fields) | set(field for field, _ in nested):
+            relation = self.relation(resource, field)
+            if not relation:
+                continue
+            related = self.fetch_embedded(relation, self.references(
+                                          field, documents))
+            for subfield in [sub for parent, sub in nested if parent == field]:
+                subrelation = self.relation(relation['resource'], subfield)
+                self.fetch_embedded(subrelation, self.references(subfield,
+                                                                 related))
+                self.replace_references(subrelation, subfield, related)
+            if field not in fields:
+                # asked only by its subfield, Eve doesn't embed it.
+                self.replace_references(relation, field, documents)
+
+    def references(self, field, documents):
+        chain = field.split('.')
+        refs = []
+        for document in documents:
+            for subdocument in subdocuments(chain[:-1], document):
+                value = subdocument.get(chain[-1])
+                refs.extend(value if isinstance(value, list) else [value])
+        # the embedded ones (dicts) are already resolved.
+        return [ref for ref in refs
+                if ref is not None and not isinstance(ref, dict)]
+
+    def replace_references(self, relation, field, documents):
+        """ Embeds the fetched documents in place of their references. """
+        chain = field.split('.')
+        embedded = lambda ref: ref if isinstance(ref, dict) else \
+            g.embedded.get((relation['resource'], ref))
+        for document in documents:
+            for subdocument in subdocuments(chain[:-1], document):
+                value = subdocument.get(chain[-1])
+                if isinstance(value, list):
+                    subdocument[chain[-1]] = map(embedded, value)
+                elif value is not None:
+                    subdocument[chain[-1]] = embedded(value)
+
+    def fetch_embedded(self, relation, refs):
+        """ Fetches the related documents of `refs` with one query, keeping
+        them (and the missing ones) in the request. Returns them.
+        """
+        resource = relation['resource']
+        key = relation.get('field', config.ID_FIELD)
+        if not hasattr(g, 'embedded'):
+            g.embedded = {}
+        missing = set(ref for ref in refs if (resource, ref) not in g.embedded)
+        if missing:
+            datasource, spec, projection, _ = self._datasource_ex(
+                resource, {key: {'$in': list(missing)}})
+            cursor = self.driver.db[datasource].find(
+                spec, self.embedded_projection(resource, projection, key))
+            for document in cursor:
+                g.embedded[(resource, document.get(key))] = document
+            for ref in missing:
+                g.embedded.setdefault((resource, ref), None)
+        # Eve also looks up the null references.
+        g.embedded[(resource, None)] = None
+        return [g.embedded[(resource, ref)] for ref in set(refs)
+                if g.embedded[(resource, ref)]]
+
+    def embedded_projection(self, resource, projection, key):
+        """ The `embedded_projection` of the resource restricted to its
+        datasource projection.
+        """
+        fields = config.DOMAIN[resource].get('embedded_projection')
+        if not fields:
+            return projection
+        fields = set(fields) | set([key])
+        if projection and 0 in projection.values():
+            fields = [f for f in fields if projection.get(f) != 0]
+        elif projection:
+            fields = [f for f in fields if projection.get(f)]
+        return dict((f, 1) for f in fields)
+
+    def request_spec(self, resource):
+        """ The MongoDB filter built by the GET of the current request for
+        `resource`: the `where`, the lookup of the hooks, the datasource
+        filter, etc. Hooks (e.g. `on_fetched_resource`) use it to run other
+        queries on the same documents.
+        """
+        return getattr(g, 'find_specs', {}).get(resource, {})
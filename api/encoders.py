@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# JSON encoder of the API responses (see `Eve(json_encoder=...)`). Before
+# encoding a payload it fires the render hooks, so they edit the payload
+# instead of decoding and encoding the response again:
+#
+#  app.on_render_<METHOD>_<resource> += func # func(payload)
+#
+# The encoding itself is done by the JSON_BACKEND: ujson (when installed),
+# simplejson (Eve's) or the standard library json.
+
+import json
+from flask import current_app, has_request_context, request
+from eve.io.mongo.mongo import MongoJSONEncoder
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def backend(name):
+    """ Resolves the JSON_BACKEND setting. `auto` is ujson when installed,
+    otherwise simplejson.
+    """
+    if name == 'auto':
+        return 'ujson' if ujson else 'simplejson'
+    if name == 'ujson' and not ujson:
+        raise ImportError('JSON_BACKEND is ujson but it is not installed.')
+    if name not in ('ujson', 'simplejson', 'json'):
+        raise ValueError('Invalid JSON_BACKEND %r' % name)
+    return name
+
+
+class ApiJSONEncoder(MongoJSONEncoder):
+    """ MongoJSONEncoder (`ObjectId` and `datetime` as Eve renders them)
+    with the render hooks and the JSON_BACKEND.
+    """
+
+    def encode(self, o):
+        if has_request_context() and '|' in (request.endpoint or ''):
+            resource = request.endpoint.split('|')[0]
+            getattr(current_app, 'on_render_%s_%s' % (request.method,
+                                                      resource))(o)
+
+        name = backend(current_app.config.get('JSON_BACKEND', 'auto'))
+        if name == 'ujson':
+            # ujson has no `default`: the special values are converted before.
+            return ujson.dumps(self.prepare(o), sort_keys=bool(self.sort_keys))
+        if name == 'json':
+            return json.dumps(o, default=self.default,
+                              sort_keys=bool(self.sort_keys))
+        return super(ApiJSONEncoder, self).encode(o)
+
+    def prepare(self, o):
+        """ Copy of `o` with the values JSON doesn't know (ObjectId, datetime)
+        converted by `default`.
+        """
+        if isinstance(o, dict):
+            return dict((k, self.prepare(v)) for k, v in o.iteritems())
+        if isinstance(o, (list, tuple)):
+            return [self.prepare(v) for v in o]
+        if o is None or isinstance(o, (basestring, bool, int, long, float)):
+            return o
+        return self.prepare(self.default(o))
@@ -3,38 +3,261 @@
 # See: http://python-eve.org/features.html#eventhooks
 
 import datetime
-import json
-import md5
 import re
-from bson import ObjectId
+import urllib
+from collections import Counter
+import flask
+from bson import ObjectId, SON, json_util
+from eve.utils import parse_request
 from flask import abort, g
-from werkzeug.security import generate_password_hash
 # app
 import api
-from utils import wrap_pattern_by_link, generate_token, JSONEncoder
+from utils import (scan_markup, join_markup, generate_token,
+                   normalize_hashtag, extract_hashtags, encode_cursor, decode_cursor, EPOCH,
+                   hash_passwords, username_from_email, md5_email)
 
 
 
+def star_votes(items):
+    """ Groups the stars inserted by comment: {comment: (ids, score)}. """
+    votes = {}
+    for item in items:
+        ids, score = votes.get(item['comment'], ([], 0))
+        ids.append(item['_id'])
+        votes[item['comment']] = (ids, score + (item.get('score') or 0))
+    return votes
+
 def after_inserted_stars_user(items):
-    """ Updates the comment defined in the star's vote.
+    """ Updates the comments defined in the star's votes: `stars_count` and
+    `stars_score` are incremented and `stars` keeps only the latest
+    STARS_EMBEDDED_MAX stars. One bulk write for all the comments voted.
+    The leaderboards are updated too.
     """
+    votes = star_votes(items)
+    if not votes:
+        return
     comments = api.database.comment
-    for item in items:
-        comment_id = item['comment']
-        pkid = item['_id']
-        # update real comment with stars _id
-        comments.update({'_id': comment_id},
-                {'$push': {'stars': pkid}}
-        )
+    bulk = comments.initialize_unordered_bulk_op()
+    for comment_id, (ids, score) in votes.items():
+        bulk.find({'_id': comment_id}).update_one({
+            '$inc': {'stars_count': len(ids), 'stars_score': score},
+            '$push': {'stars': {'$each': ids,
+                                '$slice': -api.settings.STARS_EMBEDDED_MAX}}
+        })
+    bulk.execute()
+
+    authors = dict((c['_id'], c.get('author')) for c in comments.find(
+                   {'_id': {'$in': votes.keys()}}, {'author': 1}))
+    update_star_leaders([(item['created_at'], item['comment'],
+                          authors.get(item['comment']), item.get('score') or 0)
+                         for item in items])
+
+LEADERBOARD_PERIODS = {
+    'day': lambda dt: dt.replace(hour=0, minute=0, second=0, microsecond=0),
+    'week': lambda dt: dt.replace(hour=0, minute=0, second=0, microsecond=0) -
+        datetime.timedelta(days=dt.weekday()),
+    'all': lambda dt: EPOCH,
+}
+
+def update_star_leaders(stars):
+    """ Increments the counters of the leaderboards (`comment_leaders` and
+    `author_leaders`) per day, week (from monday) and all-time. `stars` are
+    `(created_at, comment, author, score)`. One unordered bulk of upserts per
+    collection.
+    """
+    increments = {'comment_leaders': {}, 'author_leaders': {}}
+    for created_at, comment, author, score in stars:
+        for period, truncate in LEADERBOARD_PERIODS.items():
+            bucket = truncate(created_at)
+            for collection, field, ref in (('comment_leaders', 'comment', comment),
+                                           ('author_leaders', 'author', author)):
+                if ref is None:
+                    continue
+                key = (period, bucket, field, ref)
+                n, total = increments[collection].get(key, (0, 0))
+                increments[collection][key] = (n + 1, total + score)
+
+    now = datetime.datetime.utcnow()
+    retention = {
+        'day': datetime.timedelta(seconds=api.settings.LEADERBOARD_DAILY_RETENTION),
+        'week': datetime.timedelta(seconds=api.settings.LEADERBOARD_WEEKLY_RETENTION),
+    }
+    for collection, counters in increments.items():
+        if not counters:
+            continue
+        bulk = api.database[collection].initialize_unordered_bulk_op()
+        for (period, bucket, field, ref), (n, score) in counters.items():
+            on_insert = {'created_at': now}
+            if period in retention:
+                on_insert['expires_at'] = bucket + retention[period]
+            bulk.find({'period': period, 'bucket': bucket, field: ref}) \
+                .upsert().update_one({
+                    '$inc': {'stars': n, 'score': score},
+                    '$set': {'updated_at': now},
+                    '$setOnInsert': on_insert
+                })
+        bulk.execute()
+
+def before_get_leaders(request, lookup):
+    """ Top comments or authors by stars of the current day (default), week
+    or all-time: `?window=week`.
+    """
+    window = request.args.get('window', 'day')
+    if window not in LEADERBOARD_PERIODS:
+        abort(400, description="`window` must be `day`, `week` or `all`.")
+    lookup['period'] = window
+    lookup['bucket'] = LEADERBOARD_PERIODS[window](datetime.datetime.utcnow())
+
+def revoke_tokens(*user_ids):
+    """ Stops trusting the claims of the users' tokens (see
+    TOKEN_AUTH_STATELESS). Tokens issued until now expire before the
+    revocation does.
+    """
+    now = datetime.datetime.utcnow()
+    expires_at = now + datetime.timedelta(seconds=api.settings.TOKEN_EXPIRATION)
+    add_revocations([(user_id, expires_at) for user_id in user_ids])
+
+def add_revocations(revocations):
+    """ Stops trusting the claims of the tokens of `(user_id, expires_at)`
+    until `expires_at`, in every worker (see api.revoked_tokens).
+    """
+    now = datetime.datetime.utcnow()
+    revocations = [{'sub': str(user_id), 'revoked_at': now,
+                    'expires_at': expires_at}
+                   for user_id, expires_at in revocations]
+    if revocations:
+        api.database.revoked_tokens.insert(revocations)
+    for revocation in revocations:
+        api.revoked_tokens.add(revocation['sub'])
+
+def bump_cache_version(name, *changes):
+    """ Increments the version of the VersionedCache `name` by one per
+    change, recording them so the workers drop only the entries depending on
+    them. No changes means everything changed. It's one update.
+    """
+    changes = list(changes) or [None]
+    api.database.cache_versions.update({'_id': name}, {
+        '$inc': {'version': len(changes)},
+        '$push': {'changes': {'$each': changes,
+                              '$slice': -api.settings.CACHE_VERSION_CHANGES}}
+    }, upsert=True)
+
+def invalidate_token_cache(user_id=None):
+    """ Drops the accounts of the user (or all) resolved by token in all
+    workers (see api.token_cache). The others users' are kept.
+    """
+    bump_cache_version('token_auth', user_id)
+    api.token_cache.invalidate(user_id)
+
+def invalidate_me(user_id=None):
+    """ Drops the GET /me document of the user (or all) cached by all
+    workers (see api.me_cache). The others users' are kept.
+    """
+    bump_cache_version('me', user_id)
+    api.me_cache.invalidate(user_id)
+
+def after_updated_me(updates, original):
+    """ Drops the cached accounts of the user changed by `/me`. Roles or any
+    other field used by authentication can be changed there.
+    """
+    user_id = original['_id']
+    invalidate_token_cache(user_id)
+    invalidate_me(user_id)
+    if 'roles' in updates:
+        revoke_tokens(user_id)
+
+def after_deleted_item_users(item):
+    """ A deleted user must not keep authenticating from the token_cache or
+    from the claims of his token.
+    """
+    user_id = item['_id']
+    invalidate_token_cache(user_id)
+    invalidate_me(user_id)
+    revoke_tokens(user_id)
+
+def before_deleted_users():
+    """ DELETE /users removes all users. Their tokens are revoked before. """
+    users = api.database.user.find({}, {'_id': 1})
+    revoke_tokens(*[user['_id'] for user in users])
+
+def after_deleted_users():
+    """ All users were deleted (DELETE /users). """
+    invalidate_token_cache()
+    invalidate_me()
 
 def before_on_insert_users(items):
     """
+     Completes the new users before the single insert (one or bulk POST).
      Creates new token for new user. `token` must be unique and not can repeated
-     as null.
+     as null. The `_id` is allocated here because it's the token's subject and
+     the `owner` (see `auth_field` of `me`).
     """
-
+    passwords = hash_passwords([item['password'] for item in items])
+    for item, password in zip(items, passwords):
+        if '_id' not in item:
+            item['_id'] = ObjectId()
+        item['owner'] = item['_id']
+        item['password'] = password
+        item['md5_email'] = md5_email(item['email'])
+        item['token'] = generate_token(item['_id'], item.get('roles'))
+        if item.get('username'):
+            item['username_lower'] = item['username'].lower()
+
+def before_on_update_me(updates, original):
+    if updates.get('username'):
+        updates['username_lower'] = updates['username'].lower()
+
+def unique_hashtags_norm(hashtags):
+    norms = []
+    for hashtag in hashtags:
+        norm = normalize_hashtag(hashtag)
+        if norm not in norms:
+            norms.append(norm)
+    return norms
+
+def resolve_issues(items):
+    """ Returns the issues referenced by the comments, by `register` and by
+    `issue` (_id), as two dicts. It costs one `$in` query per key type for the
+    whole batch instead of one query per comment.
+    """
+    registers = set()
+    issue_ids = set()
     for item in items:
-        item['token'] = generate_token(item['email'])
+        if 'issue' not in item and 'register' in item and item['register']:
+            registers.add(item['register'])
+        elif 'issue' in item and 'register' not in item and item['issue']:
+            issue_ids.add(item['issue'])
+
+    fields = {'register': 1, 'title': 1, 'created_at': 1}
+    by_register = {}
+    by_id = {}
+    # the catalog is shared by the workers. Only its misses reach MongoDB.
+    for register in registers:
+        issue = api.issue_catalog.get(register)
+        if issue:
+            by_register[register] = issue
+    missing = registers.difference(by_register)
+    if missing:
+        lookup = {'register': {'$in': list(missing)}}
+        for issue in api.database.issue.find(lookup, fields):
+            by_register[issue['register']] = issue
+            api.issue_catalog.put(issue)
+    if issue_ids:
+        lookup = {'_id': {'$in': list(issue_ids)}}
+        for issue in api.database.issue.find(lookup, fields):
+            by_id[issue['_id']] = issue
+
+    return by_register, by_id
+
+def resolve_mentions(usernames):
+    """ Returns the `_id` of the mentioned users by username. One query for the
+    whole batch.
+    """
+    if not usernames:
+        return {}
+    lookup = {'username': {'$in': list(usernames)}}
+    users = api.database.user.find(lookup, {'username': 1})
+    return dict((user['username'], user['_id']) for user in users)
 
 def before_on_insert_comments(items):
     """
@@ -42,18 +265,28 @@ def before_on_insert_comments(items):
     `#text` and `@mention` for links within body field. This function also set
     `title` if `issue_id` not exists.
     """
-    preg = r'(#\w+)'
-
-    for item in items:
-        item['hashtags'] = re.findall(preg, item['body'])
-        item['body'] = wrap_pattern_by_link(preg, item['body'])
+    scanned = [scan_markup(item['body']) for item in items]
+    issues_by_register, issues_by_id = resolve_issues(items)
+    users = resolve_mentions(set(username for _, _, mentions in scanned
+                                          for username in mentions))
+
+    for item, (pieces, hashtags, mentions) in zip(items, scanned):
+        # only the mentions of existing users are links.
+        item['body'] = join_markup(pieces, users)
+        item['hashtags'] = hashtags
+        item['hashtags_norm'] = unique_hashtags_norm(hashtags)
+        item['mentions_users'] = []
+        for username in mentions:
+            user_id = users.get(username)
+            if user_id and user_id not in item['mentions_users']:
+                item['mentions_users'].append(user_id)
 
         if 'issue' not in item and 'register' in item and item['register']:
-            issue = api.database.issue.find_one({'register': item['register']})
-            item['issue'] = issue['_id']
+            issue = issues_by_register.get(item['register'])
+            item['issue'] = issue['_id'] if issue else None
         elif 'issue' in item and 'register' not in item:
             # issue already is within item
-            issue = api.database.issue.find_one({'_id': item['issue']})
+            issue = issues_by_id.get(item['issue'])
         else:
             issue = None
 
@@ -64,16 +297,88 @@ def before_on_insert_comments(items):
         else:
             item['title'] = 'no subject'
 
-        if 'issue' in item and item['issue']:
+        if issue and 'issue' in item and item['issue']:
             deltatime = datetime.datetime.utcnow() - issue['created_at']
             item['shottime'] = str(int(deltatime.total_seconds() / 60))
         else:
             item['shottime'] = str(datetime.datetime.today().hour) + 'h'
 
 
-def before_on_update_comments(items):
+TRENDING_PERIODS = {
+    'hour': lambda dt: dt.replace(minute=0, second=0, microsecond=0),
+    'day': lambda dt: dt.replace(hour=0, minute=0, second=0, microsecond=0),
+}
+
+def update_hashtag_stats(changes):
+    """ Increments the hourly and daily counters (`hashtag_stats`) of the
+    hashtags. `changes` are `(created_at, hashtags_norm, delta)` of comments.
+    The whole batch is one unordered bulk of upserts.
+    """
+    increments = Counter()
+    for created_at, hashtags, delta in changes:
+        for period, truncate in TRENDING_PERIODS.items():
+            for hashtag in hashtags:
+                increments[(period, truncate(created_at), hashtag)] += delta
+
+    increments = [(key, n) for key, n in increments.items() if n]
+    if not increments:
+        return
+
+    now = datetime.datetime.utcnow()
+    retention = {
+        'hour': datetime.timedelta(seconds=api.settings.TRENDING_HOURLY_RETENTION),
+        'day': datetime.timedelta(seconds=api.settings.TRENDING_DAILY_RETENTION),
+    }
+    bulk = api.database.hashtag_stats.initialize_unordered_bulk_op()
+    for (period, bucket, hashtag), n in increments:
+        lookup = {'period': period, 'bucket': bucket, 'hashtag': hashtag}
+        bulk.find(lookup).upsert().update_one({
+            '$inc': {'count': n},
+            '$set': {'updated_at': now},
+            '$setOnInsert': {'created_at': now,
+                             'expires_at': bucket + retention[period]}
+        })
+    bulk.execute()
+
+def comment_hashtags_norm(comment):
+    """ `hashtags_norm` of a comment, also the ones created before it. """
+    if 'hashtags_norm' in comment:
+        return comment['hashtags_norm']
+    return unique_hashtags_norm(comment.get('hashtags') or [])
+
+def after_inserted_comments(items):
+    update_hashtag_stats([(item['created_at'], comment_hashtags_norm(item), 1)
+                          for item in items])
+
+def after_updated_comments(updates, original):
+    """ Moves the counters of the hashtags removed or added by the edit. """
+    if 'hashtags_norm' not in updates:
+        return
+    before = set(comment_hashtags_norm(original))
+    after = set(updates['hashtags_norm'])
+    update_hashtag_stats([(original['created_at'], before - after, -1),
+                          (original['created_at'], after - before, 1)])
+
+def after_deleted_item_comments(item):
+    update_hashtag_stats([(item['created_at'], comment_hashtags_norm(item), -1)])
+
+def before_get_trending(request, lookup):
+    """ Top hashtags of the current hour (default) or day: `?window=day`. """
+    window = request.args.get('window', 'hour')
+    if window not in TRENDING_PERIODS:
+        abort(400, description="`window` must be `hour` or `day`.")
+    lookup['period'] = window
+    lookup['bucket'] = TRENDING_PERIODS[window](datetime.datetime.utcnow())
+    lookup['count'] = {'$gt': 0}
+
+def before_on_update_comments(updates, original):
+    """ Keeps `hashtags` and `hashtags_norm` in sync with an edited body. The
+    body itself is kept as sent.
+    """
     # TODO: set_shottime
-    pass
+    if 'body' in updates:
+        updates['hashtags'] = extract_hashtags(updates['body'])
+        updates['hashtags_norm'] = unique_hashtags_norm(updates['hashtags'])
 
 def before_on_insert_issue(items):
     """
@@ -85,27 +390,148 @@ def before_on_insert_issue(items):
         i['register_orig'] = i['register']
         i['register'] = i['register'].replace('/', '')
 
-def before_returning_items_from_me(response):
+# fields of the issues counted by `issue_stats`.
+ISSUE_STATS_FIELDS = ('ugat', 'ugser', 'closed', 'deadline', 'classifier',
+                      'created_at')
+
+def issue_stats_increments(issue, delta):
+    """ Yields the `(unit_type, unit, field, delta)` counted for an issue in
+    `issue_stats`. The open issues are also counted by the hour they are due
+    (`open_due.YYYYMMDDHH`) so the overdue ones are known when read.
+    """
+    for unit_type in ('ugat', 'ugser'):
+        unit = issue.get(unit_type)
+        if not unit:
+            continue
+        yield unit_type, unit, 'total', delta
+        yield unit_type, unit, 'classifiers.%s' % issue.get('classifier', 0), delta
+        if issue.get('closed'):
+            yield unit_type, unit, 'closed', delta
+            continue
+        yield unit_type, unit, 'open', delta
+        if issue.get('deadline') is not None and issue.get('created_at'):
+            due = issue['created_at'] + datetime.timedelta(
+                seconds=issue['deadline'] * api.settings.ISSUE_DEADLINE_UNIT)
+            yield unit_type, unit, 'open_due.%s' % due.strftime('%Y%m%d%H'), delta
+
+def update_issue_stats(changes, collection=None):
+    """ Applies `(issue, delta)` changes to `issue_stats` in one unordered
+    bulk of upserts.
     """
+    increments = {}
+    for issue, delta in changes:
+        for unit_type, unit, field, n in issue_stats_increments(issue, delta):
+            fields = increments.setdefault((unit_type, unit), Counter())
+            fields[field] += n
+
+    collection = collection or api.database.issue_stats
+    bulk = None
+    now = datetime.datetime.utcnow()
+    for (unit_type, unit), fields in increments.items():
+        fields = dict((field, n) for field, n in fields.items() if n)
+        if not fields:
+            continue
+        bulk = bulk or collection.initialize_unordered_bulk_op()
+        bulk.find({'unit_type': unit_type, 'unit': unit}).upsert().update_one({
+            '$inc': fields,
+            '$set': {'updated_at': now},
+            '$setOnInsert': {'created_at': now}
+        })
+    if bulk:
+        bulk.execute()
+
+def issue_stats_changed(original, updates):
+    return any(field in updates and updates[field] != original.get(field)
+               for field in ISSUE_STATS_FIELDS)
+
+def after_fetched_issue_stats(response):
+    """ Computes `overdue` from `open_due` (hour precision). """
+    now = datetime.datetime.utcnow().strftime('%Y%m%d%H')
+    for item in response['_items']:
+        open_due = item.pop('open_due', {})
+        item['overdue'] = sum(n for due, n in open_due.items() if due < now)
+
+# the organization units of the issues. The grouped issues are invalidated by
+# the units of the issues written.
+ISSUE_UNITS = ('ugat', 'ugser')
+
+def filter_units(spec):
+    """ The units a filter of the issues is restricted to: the values of
+    each unit type (ISSUE_UNITS), or None when it matches any.
     """
-    output = response['_items'][0]
+    units = []
+    for unit_type in ISSUE_UNITS:
+        value = spec.get(unit_type)
+        if isinstance(value, dict) and value.keys() == ['$in']:
+            value = value['$in']
+        if isinstance(value, basestring):
+            units.append((value,))
+        elif isinstance(value, list) and \
+                all(isinstance(v, basestring) for v in value):
+            units.append(tuple(value))
+        else:
+            units.append(None)
+    return tuple(units)
 
-    # cleaner and keeping id
-    for k, v in response.items():
-        del(response[k])
+def grouped_issues_matches(change, key, grouped):
+    """ Whether the groups cached by `key` can have an issue of the units of
+    `change` (see invalidate_grouped_issues).
+    """
+    return all(units is None or change.get(unit_type) in units
+               for unit_type, units in zip(ISSUE_UNITS, key[0]))
 
-    for k, v in output.items():
-        response[k] = v
+def invalidate_grouped_issues(*issues):
+    """ Drops the grouped issues cached by all workers whose filter can match
+    the units of the issues written, or all of them when no issue is given
+    (see api.grouped_issues_cache).
+    """
+    changes = []
+    for issue in issues:
+        change = dict((unit_type, issue.get(unit_type))
+                      for unit_type in ISSUE_UNITS)
+        if change not in changes:
+            changes.append(change)
+    bump_cache_version('issues_grouped', *changes)
+    for change in changes or [None]:
+        api.grouped_issues_cache.invalidate(change)
+
+def after_inserted_issues(items):
+    """ Adds the new issues to the issue catalog and issue_stats. """
+    for item in items:
+        api.issue_catalog.put(item)
+    update_issue_stats([(item, 1) for item in items])
+    invalidate_grouped_issues(*items)
+
+def after_updated_issues(updates, original):
+    """ Refreshes the issue in the issue catalog and issue_stats. The register
+    can change.
+    """
+    issue = dict(original, **updates)
+    if issue['register'] != original['register']:
+        api.issue_catalog.delete(original['register'])
+    api.issue_catalog.put(issue)
+    if issue_stats_changed(original, updates):
+        update_issue_stats([(original, -1), (issue, 1)])
+    invalidate_grouped_issues(original, issue)
+
+def after_deleted_item_issues(item):
+    api.issue_catalog.delete(item['register'])
+    update_issue_stats([(item, -1)])
+    invalidate_grouped_issues(item)
 
 def before_get_comments_hashtags(request, lookup):
-    """ Makes the filter `$in` in the hashtag `ListField`.
+    """ Filters by hashtag on the normalized `hashtags_norm` (indexed). It
+    matches the whole hashtag, or its beginning with `hashtag_prefix=1`.
     """
     tag = request.args.get('hashtag', None)
     u = request.args.get('u', None)
     if tag:
-        hashtag = ''.join(['#', tag])
-        patter = re.compile(r'{}'.format(tag), flags=re.IGNORECASE)
-        lookup['hashtags'] = {'$in': [patter]}
+        tag = normalize_hashtag(tag)
+        if request.args.get('hashtag_prefix') == '1':
+            # anchored and case-sensitive, so it's an index range scan.
+            lookup['hashtags_norm'] = re.compile('^' + re.escape(tag))
+        else:
+            lookup['hashtags_norm'] = tag
 
     if u:
         local_lookup = {'username': u}
@@ -113,6 +539,42 @@ def before_get_comments_hashtags(request, lookup):
         author = accounts.find_one(local_lookup)
         lookup['author'] = author['_id']
 
+def before_get_comments_after(request, lookup):
+    """ Keyset pagination of the comments: `?after=<cursor>` returns the
+    comments older than the cursor's (`created_at`, `_id`) in the
+    `default_sort` order, so no document is skipped by MongoDB.
+    """
+    after = request.args.get('after', None)
+    if after:
+        if request.args.get('page') or request.args.get('sort'):
+            abort(400, description="`after` can't be used with `page` or "
+                                   "`sort`.")
+        try:
+            created_at, _id = decode_cursor(after)
+        except ValueError:
+            abort(400, description="Invalid `after` cursor.")
+        lookup['$or'] = [{'created_at': {'$lt': created_at}},
+                         {'created_at': created_at, '_id': {'$lt': _id}}]
+
+def after_fetched_comments(response):
+    """ Makes the `next` link of the comments a cursor (see
+    before_get_comments_after) unless pages were requested by number.
+    """
+    links = response.get('_links', {})
+    if 'page' in flask.request.args or 'next' not in links \
+            or not response['_items']:
+        return
+
+    last = response['_items'][-1]
+    args = [(k, v.encode('utf-8')) for k, v in flask.request.args.items(True)
+            if k != 'after']
+    args.append(('after', encode_cursor(last['created_at'], last['_id'])))
+    links['next']['href'] = 'comments?' + urllib.urlencode(args)
+    if 'after' in flask.request.args:
+        # the page numbers of a cursor are relative to it.
+        links.pop('prev', None)
+        links.pop('last', None)
+
 def before_get_comments_search(request, lookup):
     """ Adds $text lookup if parameter search found. This feature only work
     with users and comments.
@@ -124,41 +586,18 @@ def before_get_comments_search(request, lookup):
 
 def pre_post_users(request):
     """Adds at the body data that was send by user's API the `username`
-    field. The username is the localpart from email address."""
+    field. The username is the localpart from email address. It's set before
+    the validation because it's unique. The rest is set by
+    before_on_insert_users."""
 
     if not request.json:
         abort(401, "The body data isn't a JSON format.")
 
     json_data = request.get_json()
-    username = json_data['email'].split('@')[0]
-    username = username.replace('.', '')
-    json_data['username'] = username
-    json_data['password'] = generate_password_hash(json_data['password'])
-    api.app.test_client().post(data=json.dumps(json_data),
-                    content_type='application/json')
-
-def post_post_users(request, payload):
-    """ Sets the field `owner` with _id of the user recently created. This is a
-    workaround due at `auth_field` when setted to `_id` to receive the
-    superuser's _id when to create or edit the user.
-
-    ::Explanation::
-    Only `superusers` roles can create a new user. With Eve framework is possible
-    to use `auth_field` feature to add an author for document created. But we
-    wants that the `auth_field` of the `User` model be the `_id` of the
-    recently user created instead superuser.
-    """
-    if payload.status_code == 201:
-        accounts = api.database.user
-        # recently created. to add _id for owner field.
-        data = payload.response[0]
-        json_data = json.loads(data)
-        object_id = json_data['_id']
-        accounts.update({'_id': ObjectId(object_id)},
-                        {'$set': {
-                            'owner': ObjectId(object_id),
-                            'md5_email': md5.md5(json_data['email']).hexdigest()
-                        }})
+    items = json_data if isinstance(json_data, list) else [json_data]
+    for item in items:
+        if isinstance(item, dict) and item.get('email'):
+            item['username'] = username_from_email(item['email'])
 
 def before_get_users_search(request, lookup):
     """ Adds $regex lookup if parameter search found. This feature only work
@@ -168,15 +607,29 @@ def before_get_users_search(request, lookup):
     if search:
         if search.startswith('@'):
             search = search.replace('@', '')
-        regx = re.compile(search, re.IGNORECASE)
+        # escaped: the search is a text, not a pattern.
+        regx = re.compile(re.escape(search), re.IGNORECASE)
         lookup['username'] = regx
 
-def post_post_comments_new(request, response):
-    """ This hooks fix the returned payload after added a new comment. Because
+def before_get_users_autocomplete(request, lookup):
+    """ Usernames starting with `?q=` (the @mention box of the webapp). The
+    anchored regex on `username_lower` is an index range scan and the
+    `default_sort` ranks the exact match first.
+    """
+    q = request.args.get('q', '').lstrip('@').strip().lower()
+    if not q:
+        abort(400, description="`q` is required.")
+    lookup['username_lower'] = re.compile('^' + re.escape(q))
+
+def before_render_POST_comments_user(payload):
+    """ This hooks fix the returned payload after added new comments. Because
     the resource used to create has the `comments/new` url. It's only allowed to
     access by POST. Soon isn't possible to make GET in the url built to way
     `comments/<new>/55c2542df2c3823234db80a7`.
 
+    It's a render hook (see encoders.py): it edits the payload before it's
+    serialized, for the single comment and for each of a bulk (`_items`).
+
     So changes are (samples):
 
     _links.self.href
@@ -192,33 +645,67 @@ def post_post_comments_new(request, response):
         author: {username: "username" ... }
 
     """
-
-    if response.status_code == 201:
-        data = json.loads(response.data)
-        domain = api.resources.DOMAIN # get url of the comments resource.
-
-        if 'author' in data and data['author']:
-            lookup = {"_id": ObjectId(data['author'])}
-            accounts = api.database.user
-            author = accounts.find_one(lookup)
-            data['author'] = author
-            data['_links']['self']['href'] = "".join([domain['comments']['url'], '/', data['_id']])
-            response.data = JSONEncoder().encode(data)
-
-def on_post_get_issues_with_grouped(request, response):
-    grouped = request.args.get('grouped', None)
-
-    if grouped and int(grouped) == 1 and response.status_code == 200:
-        reducer = "function(obj, prev){prev.issues.push(obj)}"
-        # TODO: get only open issues... condition
-        # TODO: get with MAX_RESULTS
-        grouped_payload = api.database.issue.group(['title'], None,
-                            {'issues':[]}, reducer)
-        data = json.loads(response.data)
-        data[u'_grouped'] = grouped_payload
-        response.data = JSONEncoder().encode(data)
+    items = payload.get('_items', [payload])
+    items = [item for item in items if item.get('_status') == 'OK' and
+             item.get('author')]
+    if not items:
+        return
+
+    domain = api.resources.DOMAIN # get url of the comments resource.
+    ids = set(ObjectId(item['author']) for item in items)
+    # the public fields, as when the users are embedded (no password, token).
+    fields = dict((field, 1) for field in
+                  domain['users']['embedded_projection'])
+    authors = dict((author['_id'], author) for author in
+                   api.database.user.find({'_id': {'$in': list(ids)}}, fields))
+    for item in items:
+        author = authors.get(ObjectId(item['author']))
+        if author:
+            item['author'] = author
+            item['_links']['self']['href'] = "".join([
+                domain['comments']['url'], '/', str(item['_id'])])
+
+# fields of the issues within the groups (`?grouped=1`).
+GROUPED_ISSUE_FIELDS = ('register', 'register_orig', 'title', 'ugat', 'ugser',
+                        'classifier', 'deadline', 'closed', 'created_at')
+
+def after_fetched_issues_grouped(response):
+    """ Adds `_grouped` to `GET /issues?grouped=1`: the issues matched by the
+    request grouped by `title`. The groups are paginated by `page` and
+    `max_results`. It's one aggregation, which walks the (title, created_at)
+    index after filtering, cached by filter and page until an issue of the
+    units of the filter changes (see invalidate_grouped_issues).
+    """
+    grouped = flask.request.args.get('grouped', None)
+    if grouped != '1':
+        return
+
+    req = parse_request('issues')
+    spec = api.app.data.request_spec('issues')
+    key = (filter_units(spec), json_util.dumps(spec, sort_keys=True), req.page,
+           req.max_results)
+    grouped = api.grouped_issues_cache.get(key)
+    if grouped is not None:
+        response['_grouped'] = grouped
+        return
+
+    issue = {'_id': '$_id'}
+    issue.update((field, '$' + field) for field in GROUPED_ISSUE_FIELDS)
+    pipeline = [
+        {'$match': spec},
+        {'$sort': SON([('title', 1), ('created_at', 1)])},
+        {'$group': {'_id': '$title', 'issues': {'$push': issue}}},
+        {'$sort': {'_id': 1}},
+    ]
+    if req.max_results:
+        pipeline.append({'$skip': (req.page - 1) * req.max_results})
+        pipeline.append({'$limit': req.max_results})
+    pipeline.append({'$project': {'_id': 0, 'title': '$_id', 'issues': 1}})
+
+    grouped = list(api.database.issue.aggregate(pipeline, cursor={}))
+    api.grouped_issues_cache.set(key, grouped)
+    response['_grouped'] = grouped
 
 
 users_hooks = {}
 users_hooks['set_username'] = pre_post_users
-users_hooks['set_owner'] = post_post_users
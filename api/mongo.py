@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# MongoDB client of the API. The same client (and so the same connection pool)
+# is used by Eve's data layer (`app.data.driver`), the hooks and the loaders
+# of the caches (`api.database`). It's configured by the MONGO_* settings:
+#
+#  MONGO_HOST, MONGO_PORT, MONGO_DBNAME, MONGO_USERNAME, MONGO_PASSWORD
+#  MONGO_MAX_POOL_SIZE, MONGO_WAIT_QUEUE_TIMEOUT_MS, MONGO_SOCKET_TIMEOUT_MS,
+#  MONGO_CONNECT_TIMEOUT_MS, MONGO_READ_PREFERENCE
+#
+# The client is created at first use in each process. The sockets of a client
+# can't be shared by the processes forked from it (e.g. gunicorn's workers), so
+# after a fork the next use creates another client.
+
+import os
+import threading
+from pymongo import MongoClient, ReadPreference
+
+
+class MongoPool(object):
+    """ Per process MongoClient created from the app's settings. It has the
+    `cx` and `db` of flask_pymongo's PyMongo, so it's the driver of the data
+    layer (see data.ApiMongo).
+    """
+
+    def __init__(self):
+        self.config = None
+        self.clients = 0
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        config = app.config
+        config.setdefault('MONGO_HOST', 'localhost')
+        config.setdefault('MONGO_PORT', 27017)
+        config.setdefault('MONGO_DBNAME', app.name)
+        config.setdefault('MONGO_READ_PREFERENCE', 'PRIMARY')
+        try:
+            int(config['MONGO_PORT'])
+        except ValueError:
+            raise TypeError('MONGO_PORT must be an integer')
+        if getattr(ReadPreference, config['MONGO_READ_PREFERENCE'],
+                   None) is None:
+            raise ValueError('Invalid MONGO_READ_PREFERENCE %r' %
+                             config['MONGO_READ_PREFERENCE'])
+        if bool(config.get('MONGO_USERNAME')) != \
+                bool(config.get('MONGO_PASSWORD')):
+            raise ValueError('Set both MONGO_USERNAME and MONGO_PASSWORD '
+                             'or neither')
+        self.config = config
+        self._pid = None
+
+    @property
+    def cx(self):
+        if self._pid != os.getpid():
+            if self.config is None:
+                raise RuntimeError('MongoPool used before init_app')
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._client = self.connect()
+                    self._pid = os.getpid()
+                    self.clients += 1
+        return self._client
+
+    @property
+    def db(self):
+        return self.cx[self.config['MONGO_DBNAME']]
+
+    def connect(self):
+        config = self.config
+        # datetimes are read naive (UTC), the driver's default: the hooks
+        # compare them with utcnow() and Eve drops their tzinfo anyway.
+        kwargs = {
+            'port': int(config['MONGO_PORT']),
+            'read_preference': getattr(ReadPreference,
+                                       config['MONGO_READ_PREFERENCE']),
+        }
+        options = (('max_pool_size', 'MONGO_MAX_POOL_SIZE'),
+                   ('waitQueueTimeoutMS', 'MONGO_WAIT_QUEUE_TIMEOUT_MS'),
+                   ('socketTimeoutMS', 'MONGO_SOCKET_TIMEOUT_MS'),
+                   ('connectTimeoutMS', 'MONGO_CONNECT_TIMEOUT_MS'))
+        for option, key in options:
+            if config.get(key) is not None:
+                kwargs[option] = config[key]
+
+        client = MongoClient(config['MONGO_HOST'], **kwargs)
+        if config.get('MONGO_USERNAME'):
+            client[config['MONGO_DBNAME']].authenticate(
+                config['MONGO_USERNAME'], config['MONGO_PASSWORD'])
+        return client
+
+    def stats(self):
+        config = self.config or {}
+        stats = {
+            'pid': self._pid,
+            'clients': self.clients,
+            'host': None,
+            'max_pool_size': config.get('MONGO_MAX_POOL_SIZE'),
+            'idle_sockets': None,
+            'wait_queue_timeout_ms': config.get('MONGO_WAIT_QUEUE_TIMEOUT_MS'),
+            'read_preference': config.get('MONGO_READ_PREFERENCE'),
+        }
+        if self._client is None or self._pid != os.getpid():
+            return stats
+        # pymongo 2.x doesn't expose its pool.
+        member = getattr(self._client, '_MongoClient__member', None)
+        if member is not None:
+            stats['host'] = '%s:%s' % member.host
+            stats['idle_sockets'] = len(member.pool.sockets)
+        return stats
+
+
+class LazyDatabase(object):
+    """ The database of a MongoPool, resolved at each use so it's always the
+    one of the current process' client.
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._pool.db, name)
+
+    def __getitem__(self, name):
+        return self._pool.db[name]
+
+
+# The client shared by the app.
+pool = MongoPool()
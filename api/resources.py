@@ -1,12 +1,18 @@
 # The `DOMAIN` is commonly put on settings but we preferences was to create
 # domains.py file.
 
-from werkzeug.security import check_password_hash
+import calendar
+import datetime
+import hmac
+import jwt
+import re
+from bson import ObjectId
 from flask import abort
 from eve.auth import BasicAuth
 import api
 from api.schemas import (users_schema, me_schema, issues_schema, comments_schema,
-        accounts_schema, stars_schema)
+        accounts_schema, stars_schema, hashtag_stats_schema, issue_stats_schema,
+        comment_leaders_schema, author_leaders_schema)
 
 
 class ApiBasicAuth(BasicAuth):
@@ -31,7 +37,9 @@ class ApiBasicAuth(BasicAuth):
         	self.set_request_auth_value(account['_id'])
 
         if account:
-        	if check_password_hash(account['password'], password):
+        	if self.check_password(username, account, password):
+        		if api.settings.TOKEN_AUTH_STATELESS:
+        			self.refresh_token(account)
         		return True
         	else:
         		abort(401,
@@ -43,6 +51,50 @@ class ApiBasicAuth(BasicAuth):
         	# iii. password invalid.
         	return False
 
+    def check_password(self, email, account, password):
+        """ Verifies the password in the hash pool. Successful verifications
+        are kept for a short time in the login_cache, keyed by the current
+        hash, so bursts of logins don't hash again.
+        """
+        cache_key = (email, account['password'])
+        digest = api.utils.password_digest(password)
+        cached = api.login_cache.get(cache_key)
+        if cached is not None and hmac.compare_digest(cached, digest):
+            return True
+
+        if api.utils.verify_password(account['password'], password):
+            api.login_cache.set(cache_key, digest)
+            return True
+        return False
+
+    def refresh_token(self, account):
+        """ Reissues the token at login when it expires soon or was issued
+        before the claims used by TOKEN_AUTH_STATELESS existed. The account is
+        read after this so the new token is returned to the client. The old
+        token is revoked.
+        """
+        try:
+            claims = api.utils.decode_token(account['token'])
+        except (jwt.InvalidTokenError, KeyError):
+            claims = None
+
+        if claims:
+            now = calendar.timegm(datetime.datetime.utcnow().utctimetuple())
+            if claims['exp'] - now > api.settings.TOKEN_REFRESH_WINDOW:
+                return
+
+        token = api.utils.generate_token(account['_id'], account.get('roles'))
+        api.app.data.driver.db['user'].update({'_id': account['_id']},
+                                              {'$set': {'token': token}})
+        # the old token stops working in every worker: its claims aren't
+        # trusted until it expires and the accounts cached by it are dropped.
+        if claims:
+            expires_at = datetime.datetime.utcfromtimestamp(claims['exp'])
+            api.hooks.add_revocations([(account['_id'], expires_at)])
+        api.hooks.invalidate_token_cache(account['_id'])
+        # the cached GET /me has the token too.
+        api.hooks.invalidate_me(account['_id'])
+
 DOMAIN = {
     'accounts': {
         'url': 'login',
@@ -81,6 +133,28 @@ DOMAIN = {
             'field': 'username'
         },
          # 'auth_field': 'owner', # bomb to backend
+        # fields of the users embedded in other resources (see data.ApiMongo).
+        'embedded_projection': ['username', 'first_name', 'last_name',
+                                'email', 'md5_email', 'avatar', 'roles'],
+        'pagination_count': 'estimated',
+    },
+    'users_autocomplete': { # @mention box: `users/autocomplete?q=<prefix>`
+        'url': 'users/autocomplete',
+        'datasource': {
+            'source': 'user',
+            'projection': {'username': 1, 'first_name': 1, 'last_name': 1,
+                           'md5_email': 1, 'avatar': 1},
+            'default_sort': [('username_lower', 1)]
+        },
+        'cache_control': '', # account cache is not needs.
+        'cache_expires': 0,
+        'resource_methods': ['GET'],
+        'item_methods': [],
+        'allowed_read_roles': ['users', 'superusers'],
+        'pagination': False,
+        'pagination_count': 'none',
+        'results_limit': 10,
+        'schema': users_schema,
     },
     'me': {
         'url': 'me',
@@ -112,6 +186,10 @@ DOMAIN = {
         'schema': issues_schema,
         'cache_control': '', # account cache is not needs.
         'cache_expires': 0,
+        'embedded_projection': ['register', 'register_orig', 'title', 'body',
+                                'ugat', 'ugser', 'classifier', 'deadline',
+                                'closed', 'created_at'],
+        'pagination_count': 'cached',
     },
     'issues_super': { # TODO to find this reference issues_super (and issues/new)
         'url': 'issues/new',
@@ -123,18 +201,39 @@ DOMAIN = {
         'allowed_read_roles': ['superusers'],
         'schema': issues_schema
     },
+    'issue_stats': { # counters by unit: `issues/stats?where={"unit_type":"ugat"}`
+        'url': 'issues/stats',
+        'datasource': {
+            'source': 'issue_stats',
+            'default_sort': [('unit_type', 1), ('unit', 1)]
+        },
+        'cache_control': '', # account cache is not needs.
+        'cache_expires': 0,
+        'resource_methods': ['GET'],
+        'item_methods': [],
+        'allowed_read_roles': ['users', 'superusers', 'admins'],
+        'schema': issue_stats_schema
+    },
     'comments': {
         'url': 'comments',
         'datasource': {
             'source': 'comment',
-            'default_sort':[('created_at', -1)]
+            # `_id` breaks the ties of the cursors (see
+            # hooks.before_get_comments_after).
+            'default_sort':[('created_at', -1), ('_id', -1)]
         },
         'cache_control': '', # account cache is not needs.
         'cache_expires': 0,
         'resource_methods': ['GET'],
         'item_methods': ['GET'],
         'schema': comments_schema,
-        'embedding': True
+        'embedding': True,
+        'embedded_projection': ['title', 'body', 'author', 'issue',
+                                'register', 'created_at'],
+        # the filters (hashtags, $text) would count thousands of comments.
+        'pagination_count': 'cached',
+        # the pages of a cursor (`?after=`) aren't counted.
+        'pagination_cursor': 'after',
     },
     'comments_user': { # created to support auth_field
         'url': 'comments/new',
@@ -169,6 +268,7 @@ DOMAIN = {
         'url': 'stars',
         'resource_methods': ['GET'],
         'item_methods': ['GET'],
+        'embedded_projection': ['voter', 'score', 'comment', 'created_at'],
         'schema': stars_schema
     },
     'stars_user' : { # create to support auth_field
@@ -183,4 +283,176 @@ DOMAIN = {
         'extra_response_fields': stars_schema.keys(),
         'schema': stars_schema
     },
+    'trending': { # top hashtags of the current hour or day (`?window=`)
+        'url': 'trending',
+        'datasource': {
+            'source': 'hashtag_stats',
+            'projection': {'period': 1, 'bucket': 1, 'hashtag': 1,
+                           'count': 1},
+            'default_sort': [('count', -1)]
+        },
+        'cache_control': '', # account cache is not needs.
+        'cache_expires': 0,
+        'resource_methods': ['GET'],
+        'item_methods': [],
+        'pagination_count': 'none',
+        'schema': hashtag_stats_schema
+    },
+    'comment_leaders': { # most starred comments (`?window=<day|week|all>`)
+        'url': 'leaders/comments',
+        'datasource': {
+            'source': 'comment_leaders',
+            'projection': {'period': 1, 'bucket': 1, 'comment': 1,
+                           'stars': 1, 'score': 1},
+            'default_sort': [('stars', -1)]
+        },
+        'cache_control': '', # account cache is not needs.
+        'cache_expires': 0,
+        'resource_methods': ['GET'],
+        'item_methods': [],
+        'pagination': False, # top-N: `max_results` up to `results_limit`.
+        'pagination_count': 'none',
+        'results_limit': 100,
+        'schema': comment_leaders_schema
+    },
+    'author_leaders': { # most starred authors (`?window=<day|week|all>`)
+        'url': 'leaders/authors',
+        'datasource': {
+            'source': 'author_leaders',
+            'projection': {'period': 1, 'bucket': 1, 'author': 1,
+                           'stars': 1, 'score': 1},
+            'default_sort': [('stars', -1)]
+        },
+        'cache_control': '', # account cache is not needs.
+        'cache_expires': 0,
+        'resource_methods': ['GET'],
+        'item_methods': [],
+        'pagination': False,
+        'pagination_count': 'none',
+        'results_limit': 100,
+        'schema': author_leaders_schema
+    },
+}
+
+# Indexes of the collections (datasources) used by the DOMAIN. Each entry has
+# the index `keys`, its `options` and the `queries` (lookup and sort) that it
+# must serve. `manage.py ensureindexes` builds them and explains the queries.
+INDEXES = {
+    'user': [
+        # ApiTokenAuth.check_auth. Unique like email and username: the
+        # `unique` validation can't stop concurrent inserts (e.g. importusers
+        # and POST /users), these indexes do. Users created before username
+        # existed haven't it, hence sparse.
+        {'keys': [('token', 1)],
+         'options': {'unique': True, 'sparse': True},
+         'queries': [{'lookup': {'token': '', 'roles': {'$in': ['users']}}}]},
+        # ApiBasicAuth.check_auth and the `unique` validation.
+        {'keys': [('email', 1)],
+         'options': {'unique': True},
+         'queries': [{'lookup': {'email': ''}}]},
+        # users additional_lookup, `?u=` of the comments.
+        {'keys': [('username', 1)],
+         'options': {'unique': True, 'sparse': True},
+         'queries': [{'lookup': {'username': ''}}]},
+        # users_autocomplete
+        {'keys': [('username_lower', 1)],
+         'queries': [{'lookup': {'username_lower': re.compile('^user')},
+                      'sort': [('username_lower', 1)]}]},
+        # auth_field of /me
+        {'keys': [('owner', 1)],
+         'queries': [{'lookup': {'owner': ObjectId()}}]},
+    ],
+    'issue': [
+        # issues additional_lookup, before_on_insert_comments and the upserts
+        # of importissues. Unique so an import racing another one (or POST
+        # /issues) fails instead of duplicating the issue.
+        {'keys': [('register', 1)],
+         'options': {'unique': True},
+         'queries': [{'lookup': {'register': ''}}]},
+        # hooks.after_fetched_issues_grouped
+        {'keys': [('title', 1), ('created_at', 1)],
+         'queries': [{'lookup': {}, 'sort': [('title', 1), ('created_at', 1)]}]},
+    ],
+    'comment': [
+        # default_sort and `?after=` cursors of the comments
+        {'keys': [('created_at', -1), ('_id', -1)],
+         'queries': [{'lookup': {}, 'sort': [('created_at', -1), ('_id', -1)]},
+                     {'lookup': {'$or': [
+                        {'created_at': {'$lt': datetime.datetime.utcnow()}},
+                        {'created_at': datetime.datetime.utcnow(),
+                         '_id': {'$lt': ObjectId()}}]},
+                      'sort': [('created_at', -1), ('_id', -1)]}]},
+        # before_get_comments_hashtags
+        {'keys': [('hashtags_norm', 1)],
+         'queries': [{'lookup': {'hashtags_norm': 'hashtag'}},
+                     {'lookup': {'hashtags_norm': re.compile('^hash')}}]},
+        {'keys': [('author', 1)],
+         'queries': [{'lookup': {'author': ObjectId()}}]},
+        # before_get_comments_search
+        {'keys': [('body', 'text'), ('title', 'text')],
+         'options': {'default_language': 'portuguese'},
+         'queries': [{'lookup': {'$text': {'$search': 'siscomando'}}}]},
+    ],
+    'hashtag_stats': [
+        # hooks.update_hashtag_stats upserts
+        {'keys': [('period', 1), ('bucket', 1), ('hashtag', 1)],
+         'options': {'unique': True},
+         'queries': [{'lookup': {'period': 'hour', 'bucket': datetime.datetime(2015, 1, 1),
+                                 'hashtag': 'siscomando'}}]},
+        # trending
+        {'keys': [('period', 1), ('bucket', 1), ('count', -1)],
+         'queries': [{'lookup': {'period': 'hour', 'bucket': datetime.datetime(2015, 1, 1),
+                                 'count': {'$gt': 0}},
+                      'sort': [('count', -1)]}]},
+        # removes the buckets older than TRENDING_*_RETENTION.
+        {'keys': [('expires_at', 1)],
+         'options': {'expireAfterSeconds': 0}},
+    ],
+    'comment_leaders': [
+        # hooks.update_star_leaders upserts
+        {'keys': [('period', 1), ('bucket', 1), ('comment', 1)],
+         'options': {'unique': True},
+         'queries': [{'lookup': {'period': 'day', 'bucket': datetime.datetime(2015, 1, 1),
+                                 'comment': ObjectId()}}]},
+        # leaders/comments
+        {'keys': [('period', 1), ('bucket', 1), ('stars', -1)],
+         'queries': [{'lookup': {'period': 'day', 'bucket': datetime.datetime(2015, 1, 1)},
+                      'sort': [('stars', -1)]}]},
+        # removes the buckets older than LEADERBOARD_*_RETENTION.
+        {'keys': [('expires_at', 1)],
+         'options': {'expireAfterSeconds': 0}},
+    ],
+    'author_leaders': [
+        # hooks.update_star_leaders upserts
+        {'keys': [('period', 1), ('bucket', 1), ('author', 1)],
+         'options': {'unique': True},
+         'queries': [{'lookup': {'period': 'day', 'bucket': datetime.datetime(2015, 1, 1),
+                                 'author': ObjectId()}}]},
+        # leaders/authors
+        {'keys': [('period', 1), ('bucket', 1), ('stars', -1)],
+         'queries': [{'lookup': {'period': 'day', 'bucket': datetime.datetime(2015, 1, 1)},
+                      'sort': [('stars', -1)]}]},
+        # removes the buckets older than LEADERBOARD_*_RETENTION.
+        {'keys': [('expires_at', 1)],
+         'options': {'expireAfterSeconds': 0}},
+    ],
+    'stars': [
+        # `manage.py backfill stars`, the stars of a batch of comments.
+        {'keys': [('comment', 1), ('created_at', 1)],
+         'queries': [{'lookup': {'comment': {'$in': [ObjectId()]}},
+                      'sort': [('created_at', 1)]}]},
+    ],
+    'issue_stats': [
+        # hooks.update_issue_stats upserts and the default_sort.
+        {'keys': [('unit_type', 1), ('unit', 1)],
+         'options': {'unique': True},
+         'queries': [{'lookup': {'unit_type': 'ugat', 'unit': 'SUPOP'}},
+                     {'lookup': {}, 'sort': [('unit_type', 1), ('unit', 1)]}]},
+    ],
+    'revoked_tokens': [
+        # removes the revocations when the revoked tokens expired.
+        {'keys': [('expires_at', 1)],
+         'options': {'expireAfterSeconds': 0},
+         'queries': [{'lookup': {'expires_at': {'$gt': datetime.datetime.utcnow()}}}]},
+    ],
 }
@@ -46,6 +46,10 @@ users_schema = {
 		'type': 'string',
 		'unique': True
 	},
+	'username_lower': { # See hooks.before_get_users_autocomplete
+		'type': 'string',
+		'readonly': True
+	},
 	'avatar': {
 		'type': 'string'
 	},
@@ -85,6 +89,10 @@ me_schema = {
 		'type': 'string',
 		'unique': True
 	},
+	'username_lower': { # See hooks.before_get_users_autocomplete
+		'type': 'string',
+		'readonly': True
+	},
 	'avatar': {
 		'type': 'string'
 	},
@@ -221,8 +229,8 @@ comments_schema = {
 		},
 		'readonly': True
 	},
-	# 'stars': this is inject by hooks
-	# TODO: expand sublevels as voter.
+	# 'stars': this is inject by hooks, only the latest STARS_EMBEDDED_MAX.
+	# `embedded={"stars.voter":1}` also embeds the voters (see data.ApiMongo).
 	'stars': {
 		'type': 'list',
 		'schema': {
@@ -235,6 +243,17 @@ comments_schema = {
 		},
 		'readonly': True
 	},
+	# counters of all stars. See hooks.after_inserted_stars_user
+	'stars_count': {
+		'type': 'integer',
+		'default': 0,
+		'readonly': True
+	},
+	'stars_score': {
+		'type': 'integer',
+		'default': 0,
+		'readonly': True
+	},
 	# Ordinary fields
 	'shottime': {
 		'type': 'integer',
@@ -265,5 +284,107 @@ comments_schema = {
 	'hashtags': {
 		'type': 'list',
 		'readonly': True
+	},
+	# lowercase hashtags without `#`. See before_get_comments_hashtags.
+	'hashtags_norm': {
+		'type': 'list',
+		'readonly': True
+	}
+}
+
+# stars counters (`stars`, `score`) per day, week and all-time of the comments
+# and of their authors. Kept by the stars hooks.
+comment_leaders_schema = {
+	'period': {
+		'type': 'string',
+		'allowed': ['day', 'week', 'all'],
+		'readonly': True
+	},
+	'bucket': {
+		'type': 'datetime',
+		'readonly': True
+	},
+	'comment': {
+		'type': 'objectid',
+		'data_relation': {
+			'resource': 'comments',
+			'field': '_id',
+			'embeddable': True
+		},
+		'readonly': True
+	},
+	'stars': {
+		'type': 'integer',
+		'readonly': True
+	},
+	'score': {
+		'type': 'integer',
+		'readonly': True
+	}
+}
+
+author_leaders_schema = dict(comment_leaders_schema)
+del author_leaders_schema['comment']
+author_leaders_schema['author'] = {
+	'type': 'objectid',
+	'data_relation': {
+		'resource': 'users',
+		'field': '_id',
+		'embeddable': True
+	},
+	'readonly': True
+}
+
+# counters of the hashtags per hour and per day. Kept by the comments hooks.
+hashtag_stats_schema = {
+	'period': {
+		'type': 'string',
+		'allowed': ['hour', 'day'],
+		'readonly': True
+	},
+	'bucket': {
+		'type': 'datetime',
+		'readonly': True
+	},
+	'hashtag': {
+		'type': 'string',
+		'readonly': True
+	},
+	'count': {
+		'type': 'integer',
+		'readonly': True
+	}
+}
+
+# counters of the issues per unit (ugat or ugser). Kept by the issues hooks.
+issue_stats_schema = {
+	'unit_type': {
+		'type': 'string',
+		'allowed': ['ugat', 'ugser'],
+		'readonly': True
+	},
+	'unit': {
+		'type': 'string',
+		'readonly': True
+	},
+	'total': {
+		'type': 'integer',
+		'readonly': True
+	},
+	'open': {
+		'type': 'integer',
+		'readonly': True
+	},
+	'closed': {
+		'type': 'integer',
+		'readonly': True
+	},
+	'classifiers': {
+		'type': 'dict',
+		'readonly': True
+	},
+	'open_due': { # not returned. See hooks.after_fetched_issue_stats
+		'type': 'dict',
+		'readonly': True
 	}
 }
@@ -13,9 +13,18 @@ DEBUG = True
 
 # Database setup
 MONGO_HOST = "localhost"
-MONGO_POST = "27017"
+MONGO_PORT = 27017
 # MONGO_DBNAME is temporally added hard but place it app's global settings.
 MONGO_DBNAME = "dev_scdb"
+# Connection pool of each worker (see api/mongo.py). A request waits at most
+# MONGO_WAIT_QUEUE_TIMEOUT_MS for a free socket when the MONGO_MAX_POOL_SIZE
+# sockets are in use. MONGO_READ_PREFERENCE is a name of pymongo's
+# ReadPreference, e.g. SECONDARY_PREFERRED.
+MONGO_MAX_POOL_SIZE = 50
+MONGO_WAIT_QUEUE_TIMEOUT_MS = 1000
+MONGO_SOCKET_TIMEOUT_MS = 30000
+MONGO_CONNECT_TIMEOUT_MS = 5000
+MONGO_READ_PREFERENCE = "PRIMARY"
 
 # Versioning
 URL_PREFIX = "api"
@@ -38,3 +47,90 @@ IF_MATCH = False # CAUTION: temporally disabled. This keeps versions correclty u
 X_DOMAINS = '*' # You can to specify a list of domains.
 X_ALLOW_CREDENTIALS = True
 X_HEADERS = ['Authorization', 'Content-Type']
+
+# In-process cache of authenticated accounts (see ApiTokenAuth). The TTL bounds
+# how long changes made out of the API (e.g. manage.py) take to be seen. The
+# changes made by the API (PATCH /me, deleted users, logins) are seen by the
+# other workers after TOKEN_AUTH_CACHE_SYNC seconds at most.
+TOKEN_AUTH_CACHE_SIZE = 10000
+TOKEN_AUTH_CACHE_TTL = 300 # seconds
+TOKEN_AUTH_CACHE_SYNC = 1 # seconds
+
+# Tokens are HS256 JWTs (see utils.generate_token). When TOKEN_AUTH_STATELESS is
+# enabled their signature and claims authorize requests without the database,
+# which is only queried for users with revoked tokens (see hooks.revoke_tokens)
+# or for tokens issued before this mode existed. Tokens expiring within
+# TOKEN_REFRESH_WINDOW (or issued before) are reissued at login.
+TOKEN_AUTH_STATELESS = False
+TOKEN_EXPIRATION = 30 * 24 * 3600 # seconds
+TOKEN_REFRESH_WINDOW = 24 * 3600 # seconds
+# How often each worker reloads the revoked tokens and the size in bits of the
+# bloom filter that keeps them.
+TOKEN_REVOCATION_SYNC = 5 # seconds
+TOKEN_REVOCATION_BLOOM_BITS = 1 << 16
+
+# Passwords are verified (PBKDF2) in a pool of threads so the gevent workers
+# keep serving other requests. Successful logins are kept for LOGIN_CACHE_TTL
+# seconds to absorb bursts (e.g. at the start of a shift).
+PASSWORD_HASH_POOL_SIZE = 4
+LOGIN_CACHE_SIZE = 5000
+LOGIN_CACHE_TTL = 120 # seconds
+
+# Catalog of the issues (register -> _id, title, created_at) shared by the
+# workers of the host through a memory-mapped file (see api/catalog.py). It's
+# read by every comment insert. `None` disables it. The file (0600) is kept in
+# a directory of the app, created 0700. It's emptied when the database or its
+# catalog generation change, checked every ISSUE_CATALOG_SYNC seconds.
+ISSUE_CATALOG_PATH = os.environ.get('ISSUE_CATALOG_PATH',
+                    os.path.join(os.path.dirname(os.path.dirname(
+                        os.path.abspath(__file__))), 'var',
+                        '%s-issues.catalog' % MONGO_DBNAME))
+ISSUE_CATALOG_SLOTS = 32768 # 12MB
+ISSUE_CATALOG_SYNC = 60 # seconds
+
+# How the `_meta.total` of the collections is computed: exact, cached,
+# estimated or none (see data.CountingCursor). Each resource can override it
+# with `pagination_count` in the DOMAIN.
+PAGINATION_COUNT = 'exact'
+PAGINATION_COUNT_CACHE_SIZE = 1000
+PAGINATION_COUNT_CACHE_TTL = 30 # seconds
+
+# How long the hourly and daily counters of the hashtags (trending) are kept.
+TRENDING_HOURLY_RETENTION = 2 * 24 * 3600 # seconds
+TRENDING_DAILY_RETENTION = 90 * 24 * 3600 # seconds
+
+# Cache of `GET /issues?grouped=1` in each worker. Writes to the issues are seen
+# by the other workers after GROUPED_ISSUES_CACHE_SYNC seconds at most. Only
+# the filters that can match the units (ugat, ugser) of the issues written are
+# dropped.
+GROUPED_ISSUES_CACHE_SIZE = 500
+GROUPED_ISSUES_CACHE_TTL = 300 # seconds
+GROUPED_ISSUES_CACHE_SYNC = 1 # seconds
+
+# Seconds per unit of the issues' `deadline` (minutes). Used by issue_stats to
+# count the overdue issues.
+ISSUE_DEADLINE_UNIT = 60
+
+# Serializer of the responses (see api/encoders.py): auto, ujson, simplejson or
+# json. `auto` is ujson when it's installed, otherwise simplejson.
+JSON_BACKEND = 'auto'
+
+# Stars kept in the comments (`stars`), the latest ones. All of them are in the
+# stars collection and counted by `stars_count` and `stars_score`.
+STARS_EMBEDDED_MAX = 50
+
+# How long the daily and weekly buckets of the stars leaderboards are kept. The
+# all-time ones are kept forever.
+LEADERBOARD_DAILY_RETENTION = 8 * 24 * 3600 # seconds
+LEADERBOARD_WEEKLY_RETENTION = 5 * 7 * 24 * 3600 # seconds
+
+# Cache of GET /me in each worker. A PATCH of /me is seen by the other workers
+# after ME_CACHE_SYNC seconds at most.
+ME_CACHE_SIZE = 5000
+ME_CACHE_TTL = 300 # seconds
+ME_CACHE_SYNC = 1 # seconds
+
+# Changes (e.g. users) kept with the version of each cache shared by the
+# workers (see cache.VersionedCache). A worker that missed more changes than
+# this since its last sync drops its whole cache.
+CACHE_VERSION_CHANGES = 256
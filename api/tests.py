@@ -7,6 +7,8 @@ import random
 import base64
 import datetime
 import re
+import time
+import jwt
 from pymongo import MongoClient
 from bson import ObjectId
 from werkzeug.security import generate_password_hash
@@ -190,6 +192,22 @@ class UserTestCase(ApiTests):
 			qtd_last_page = total - ((last_page - 1) * MAX_RESULTS)
 			self.assertEqual(len(data), qtd_last_page)
 
+	def test_get_users_total_mode(self):
+		""" tests if _meta tells how the total was computed (users are
+		`estimated` when unfiltered).
+		"""
+		token = self.get_token_api('u@user.com', '123')
+		r = requests.get(self.concat('users'),
+			headers={"Authorization": "Basic {}".format(token)})
+		meta = json.loads(r.text)['_meta']
+		self.assertEqual(meta['total_mode'], 'estimated')
+		self.assertIn('total', meta)
+
+		r = requests.get(self.concat('users?search=u'),
+			headers={"Authorization": "Basic {}".format(token)})
+		meta = json.loads(r.text)['_meta']
+		self.assertEqual(meta['total_mode'], 'cached')
+
 	def test_get_me(self):
 		""" Tests access in the /me """
 		# adding user with users role
@@ -231,6 +249,36 @@ class UserTestCase(ApiTests):
 		data = json.loads(r.text)
 		self.assertEqual(data['first_name'], 'Mario')
 
+	def test_get_me_cached(self):
+		""" tests if /me is served again from the cache and changed by PATCH """
+		token = self.get_token_api('s@super.com', '123')
+		r = requests.post(self.concat('users'),
+			headers={"Authorization": "Basic {}".format(token)},
+			json=self.data)
+		user_id = json.loads(r.text)['_id']
+		token_new = self.get_token(json.loads(r.text)['token'])
+		for _ in range(2):
+			r = requests.get(self.concat('me'),
+				headers={"Authorization": "Basic {}".format(token_new)})
+			self.assertEqual(r.status_code, 200)
+			data = json.loads(r.text)
+			self.assertEqual(data['_id'], user_id)
+			self.assertNotIn('_items', data)
+			self.assertNotIn('password', data)
+		r = requests.patch(self.concat('me/{}'.format(user_id)),
+			headers={"Authorization": "Basic {}".format(token_new)},
+			json={'first_name': 'Cached'})
+		# only this user's document is dropped by the other workers.
+		version = DATABASE.cache_versions.find_one({'_id': 'me'})
+		self.assertEqual(version['changes'][-1], ObjectId(user_id))
+		r = requests.get(self.concat('me'),
+			headers={"Authorization": "Basic {}".format(token_new)})
+		self.assertEqual(json.loads(r.text)['first_name'], 'Cached')
+		r = requests.get(self.concat('_stats'),
+			headers={"Authorization": "Basic {}".format(token)})
+		stats = json.loads(r.text)['caches']['me']
+		self.assertGreaterEqual(stats['hits'], 1)
+
 	def test_patch_edit_another_user_by_me(self):
 		""" tests changes in own user.
 		"""
@@ -359,6 +407,28 @@ class UserTestCase(ApiTests):
 		self.assertEqual(json_load['owner'], object_id)
 
 	# DELETE tests
+	def test_post_users_bulk(self):
+		""" tests adds many users in one request """
+		token = self.get_token_api('s@super.com', '123')
+		number = random.randint(1, 100000)
+		users = [{'email': 'bulk.{}.{}@example.com'.format(number, i),
+				'password': '123'} for i in range(3)]
+		r = requests.post(self.concat('users'),
+			headers={"Authorization": "Basic {}".format(token)},
+			json=users)
+		self.assertEqual(r.status_code, 201)
+		items = json.loads(r.text)['_items']
+		self.assertEqual(len(items), 3)
+		for user, item in zip(users, items):
+			saved = DATABASE.user.find_one({'_id': ObjectId(item['_id'])})
+			self.assertEqual(saved['owner'], saved['_id'])
+			self.assertEqual(saved['username'],
+				user['email'].split('@')[0].replace('.', ''))
+			self.assertEqual(saved['md5_email'],
+				md5.md5(user['email']).hexdigest())
+			self.assertTrue(saved['password'].startswith('pbkdf2'))
+			self.assertEqual(item['token'], saved['token'])
+
 	def test_delete_users_by_users(self):
 		""" trying delete an user as ordinary user """
 		# Adding an user
@@ -439,6 +509,31 @@ class UserTestCase(ApiTests):
 		username_sent = self.data['email'].split('@')[0].replace('.', '')
 		self.assertEqual(username_sent, username_saved)
 
+	def test_autocomplete_users(self):
+		""" tests if users are found by the beginning of the username """
+		token = self.get_token_api('s@super.com', '123')
+		r = requests.post(self.concat('users'), json=self.data,
+			headers={"Authorization": "Basic {}".format(token)})
+		self.assertEqual(r.status_code, 201)
+		username = self.data['email'].split('@')[0].replace('.', '')
+		u = DATABASE.user.find_one({'username': username})
+		self.assertEqual(u['username_lower'], username.lower())
+
+		q = '@' + username[:3].upper()
+		r = requests.get(self.concat('users/autocomplete?q={}'.format(q)),
+			headers={"Authorization": "Basic {}".format(token)})
+		self.assertEqual(r.status_code, 200)
+		items = json.loads(r.text)['_items']
+		self.assertLessEqual(len(items), 10)
+		self.assertIn(username, [item['username'] for item in items])
+		self.assertNotIn('email', items[0])
+		self.assertNotIn('token', items[0])
+
+		# regex characters are text.
+		r = requests.get(self.concat('users/autocomplete?q=.*'),
+			headers={"Authorization": "Basic {}".format(token)})
+		self.assertEqual(json.loads(r.text)['_items'], [])
+
 	def test_set_password_is_not_plain_text(self):
 		""" tests if password is not plain text """
 		# trying to add an user
@@ -468,9 +563,65 @@ class UserTestCase(ApiTests):
 		md5_email = json_data['md5_email']
 		self.assertEqual(md5_email, md5.md5(self.data['email']).hexdigest())
 
-	@unittest.skip(u"this isn't implemented")
 	def test_token_generated(self):
-		pass
+		""" tests if the token is a JWT with the claims used by the stateless
+		authentication (sub is the user's _id).
+		"""
+		token = self.get_token_api('s@super.com', '123')
+		r = requests.post(self.concat('users'),
+			headers={"Authorization": "Basic {}".format(token)},
+			json=self.data)
+		self.assertEqual(r.status_code, 201)
+		data = json.loads(r.text)
+		encoded = base64.b64decode(data['token'])[:-1] # ends with ':'
+		claims = jwt.decode(encoded, verify=False)
+		self.assertEqual(claims['sub'], data['_id'])
+		self.assertIn('iat', claims)
+		self.assertIn('exp', claims)
+		self.assertEqual(claims['roles'], self.data['roles'])
+
+	def test_token_cache_version(self):
+		""" tests if a bump of the token_auth version recording a user (made
+		by the users hooks of any worker) drops his cached accounts: a user
+		removed from the database stops authenticating.
+		"""
+		token = self.get_token_api('s@super.com', '123')
+		r = requests.post(self.concat('users'),
+			headers={"Authorization": "Basic {}".format(token)},
+			json=self.data)
+		user_id = json.loads(r.text)['_id']
+		token_new = self.get_token(json.loads(r.text)['token'])
+		r = requests.get(self.concat('me'),
+			headers={"Authorization": "Basic {}".format(token_new)})
+		self.assertEqual(r.status_code, 200)
+		DATABASE.user.remove({'_id': ObjectId(user_id)})
+		DATABASE.revoked_tokens.insert({'sub': user_id,
+			'revoked_at': datetime.datetime.utcnow(),
+			'expires_at': datetime.datetime.utcnow() + datetime.timedelta(days=1)})
+		DATABASE.cache_versions.update({'_id': 'token_auth'},
+			{'$inc': {'version': 1}, '$push': {'changes': ObjectId(user_id)}},
+			upsert=True)
+		time.sleep(6) # TOKEN_AUTH_CACHE_SYNC and TOKEN_REVOCATION_SYNC
+		r = requests.get(self.concat('me'),
+			headers={"Authorization": "Basic {}".format(token_new)})
+		self.assertEqual(r.status_code, 401)
+
+	def test_runtime_stats_token_cache(self):
+		""" tests the token_auth cache counters exposed at _stats. Only
+		superusers can read them.
+		"""
+		token = self.get_token_api('u@user.com', '123')
+		r = requests.get(self.concat('_stats'),
+			headers={"Authorization": "Basic {}".format(token)})
+		self.assertEqual(r.status_code, 401)
+		token = self.get_token_api('s@super.com', '123')
+		r = requests.get(self.concat('_stats'),
+			headers={"Authorization": "Basic {}".format(token)})
+		self.assertEqual(r.status_code, 200)
+		data = json.loads(r.text)
+		self.assertIn('token_auth', data['caches'])
+		self.assertIn('hits', data['caches']['token_auth'])
+		self.assertIn('misses', data['caches']['token_auth'])
 
 
 class IssueTestCase(ApiTests):
@@ -598,6 +749,115 @@ class IssueTestCase(ApiTests):
 		self.assertIsInstance(data['_grouped'], list)
 		self.assertEqual(len(data['_grouped'][0].keys()), 2)
 
+	def test_get_with_grouped_filtered(self):
+		""" tests if the groups follow the filters and the pagination """
+		title = 'GROUPED {}'.format(random.randint(1, 100000))
+		for i in range(2):
+			issue = dict(self.issue, title=title,
+				register='2015GR/{}'.format(random.randint(1, 10 ** 9)))
+			r = requests.post(self.concat('issues'),
+				headers={"Authorization": "Basic {}".format(self.super_token)},
+				json=issue)
+			self.assertEqual(r.status_code, 201)
+
+		r = requests.get(self.concat('issues?grouped=1&where={{"title":"{}"}}'.format(title)),
+			headers={"Authorization": "Basic {}".format(self.super_token)})
+		grouped = json.loads(r.text)['_grouped']
+		self.assertEqual([g['title'] for g in grouped], [title])
+		self.assertEqual(len(grouped[0]['issues']), 2)
+		self.assertNotIn('body', grouped[0]['issues'][0])
+
+		r = requests.get(self.concat('issues?grouped=1&max_results=1&page=2'),
+			headers={"Authorization": "Basic {}".format(self.super_token)})
+		self.assertLessEqual(len(json.loads(r.text)['_grouped']), 1)
+
+	def test_get_with_grouped_cache_invalidated(self):
+		""" tests if the cached groups follow new and updated issues """
+		title = 'GROUPED CACHE {}'.format(random.randint(1, 100000))
+		link = 'issues?grouped=1&where={{"title":"{}"}}'.format(title)
+		def grouped_registers():
+			# the other workers see the writes after GROUPED_ISSUES_CACHE_SYNC.
+			time.sleep(1.1)
+			r = requests.get(self.concat(link),
+				headers={"Authorization": "Basic {}".format(self.super_token)})
+			grouped = json.loads(r.text)['_grouped']
+			return [i['register'] for g in grouped for i in g['issues']]
+
+		self.assertEqual(grouped_registers(), [])
+		issue = dict(self.issue, title=title,
+			register='2015GC/{}'.format(random.randint(1, 10 ** 9)))
+		r = requests.post(self.concat('issues'),
+			headers={"Authorization": "Basic {}".format(self.super_token)},
+			json=issue)
+		self.assertEqual(r.status_code, 201)
+		issue_id = json.loads(r.text)['_id']
+		register = issue['register'].replace('/', '')
+		# the other workers drop only the filters matching its units.
+		version = DATABASE.cache_versions.find_one({'_id': 'issues_grouped'})
+		self.assertEqual(version['changes'][-1],
+			{'ugat': issue['ugat'], 'ugser': issue['ugser']})
+		self.assertEqual(grouped_registers(), [register])
+
+		r = requests.patch(self.concat('issues/{}'.format(issue_id)),
+			headers={"Authorization": "Basic {}".format(self.super_token)},
+			json={'title': title + ' UPDATED'})
+		self.assertEqual(r.status_code, 200)
+		self.assertEqual(grouped_registers(), [])
+
+	def test_issue_stats(self):
+		""" tests if the counters by unit follow new and updated issues """
+		unit = 'T{}'.format(random.randint(1, 999999))
+		issue = dict(self.issue, ugat=unit,
+			register='2015ST/{}'.format(random.randint(1, 10 ** 9)))
+		r = requests.post(self.concat('issues'),
+			headers={"Authorization": "Basic {}".format(self.super_token)},
+			json=issue)
+		self.assertEqual(r.status_code, 201)
+		issue_id = json.loads(r.text)['_id']
+
+		def stats():
+			link = 'issues/stats?where={{"unit_type":"ugat","unit":"{}"}}'
+			r = requests.get(self.concat(link.format(unit)),
+				headers={"Authorization": "Basic {}".format(self.user_token)})
+			self.assertEqual(r.status_code, 200)
+			items = json.loads(r.text)['_items']
+			self.assertEqual(len(items), 1)
+			return items[0]
+
+		data = stats()
+		self.assertEqual((data['total'], data['open'], data['overdue']), (1, 1, 0))
+		self.assertEqual(data['classifiers'], {'0': 1})
+		self.assertNotIn('open_due', data)
+
+		r = requests.patch(self.concat('issues/{}'.format(issue_id)),
+			headers={"Authorization": "Basic {}".format(self.super_token)},
+			json={'closed': True})
+		self.assertEqual(r.status_code, 200)
+		data = stats()
+		self.assertEqual((data['total'], data['open'], data['closed']), (1, 0, 1))
+
+	def test_runtime_stats_grouped_issues(self):
+		""" tests if the cache of the grouped issues is in the _stats """
+		r = requests.get(self.concat('_stats'),
+			headers={"Authorization": "Basic {}".format(self.super_token)})
+		self.assertEqual(r.status_code, 200)
+		stats = json.loads(r.text)['caches']['issues_grouped']
+		for key in ('hits', 'misses', 'hit_rate', 'invalidations', 'version'):
+			self.assertIn(key, stats)
+
+	def test_runtime_stats_mongo_pool(self):
+		""" tests if the worker's MongoDB pool is in the _stats """
+		r = requests.get(self.concat('_stats'),
+			headers={"Authorization": "Basic {}".format(self.super_token)})
+		self.assertEqual(r.status_code, 200)
+		data = json.loads(r.text)
+		stats = data['caches']['mongo_pool']
+		self.assertEqual(stats['pid'], data['pid'])
+		self.assertEqual(stats['clients'], 1)
+		for key in ('host', 'max_pool_size', 'idle_sockets',
+					'wait_queue_timeout_ms', 'read_preference'):
+			self.assertIn(key, stats)
+
 	def test_update_and_create_not_superusers(self):
 		# TODO
 		pass
@@ -642,6 +902,21 @@ class CommentTestCase(ApiTests):
 		self.assertIn('created_at', data)
 		self.assertIn('updated_at', data)
 
+	def test_post_comment_author_public_fields(self):
+		""" tests if the author embedded in the POST response (single and
+		bulk) hasn't the password and the token.
+		"""
+		for body in (self.minimal_comment, [self.minimal_comment] * 2):
+			r = requests.post(self.concat('comments/new'),
+				headers={"Authorization": "Basic {}".format(self.user_token)},
+				json=body)
+			self.assertEqual(r.status_code, 201)
+			data = json.loads(r.text)
+			for item in data.get('_items', [data]):
+				self.assertEqual(item['author']['_id'], str(self.u))
+				self.assertNotIn('password', item['author'])
+				self.assertNotIn('token', item['author'])
+
 	def test_post_with_hashtag(self):
 		# add new comment
 		self.minimal_comment['body'] += " #TagNew"
@@ -731,6 +1006,39 @@ class CommentTestCase(ApiTests):
 		item = data['_items'][0]
 		self.assertEqual(item['body'], self.minimal_comment['body'])
 
+	def test_get_comments_after(self):
+		""" tests if the next link is a cursor continuing the first page and
+		if pages by number keep working.
+		"""
+		for _ in range(3):
+			r = requests.post(self.concat('comments/new'),
+				headers={"Authorization": "Basic {}".format(self.user_token)},
+				json=self.minimal_comment)
+			self.assertEqual(r.status_code, 201)
+
+		r = requests.get(self.concat('comments?max_results=2'),
+			headers={"Authorization": "Basic {}".format(self.user_token)})
+		first = json.loads(r.text)
+		self.assertIn('after=', first['_links']['next']['href'])
+
+		r = requests.get(self.concat(first['_links']['next']['href']),
+			headers={"Authorization": "Basic {}".format(self.user_token)})
+		self.assertEqual(r.status_code, 200)
+		cursor_page = json.loads(r.text)
+		self.assertEqual(cursor_page['_meta']['total_mode'], 'none')
+		self.assertNotIn('total', cursor_page['_meta'])
+
+		r = requests.get(self.concat('comments?max_results=2&page=2'),
+			headers={"Authorization": "Basic {}".format(self.user_token)})
+		number_page = json.loads(r.text)
+		self.assertIn('page=3', number_page['_links']['next']['href'])
+		self.assertEqual([i['_id'] for i in cursor_page['_items']],
+						[i['_id'] for i in number_page['_items']])
+
+		r = requests.get(self.concat('comments?after=invalid'),
+			headers={"Authorization": "Basic {}".format(self.user_token)})
+		self.assertEqual(r.status_code, 400)
+
 	def test_get_comments_tags(self):
 		""" tests resource comments_hashtag
 		"""
@@ -745,6 +1053,61 @@ class CommentTestCase(ApiTests):
 		data = json.loads(r.text)
 		self.assertGreaterEqual(len(data['_items']), 1)
 
+	def test_get_trending(self):
+		""" tests if the hashtags of new, edited and deleted comments are
+		counted in the trending.
+		"""
+		tag = 'trend{}'.format(random.randint(1, 100000))
+		where = 'where={{"hashtag":"{}"}}'.format(tag)
+		self.minimal_comment['body'] += ' #{}'.format(tag)
+		ids = []
+		for _ in range(2):
+			r = requests.post(self.concat('comments/new'),
+				headers={"Authorization": "Basic {}".format(self.user_token)},
+				json=self.minimal_comment)
+			ids.append(json.loads(r.text)['_id'])
+
+		def count(window):
+			r = requests.get(self.concat('trending?window={}&{}'.format(window, where)),
+				headers={"Authorization": "Basic {}".format(self.user_token)})
+			self.assertEqual(r.status_code, 200)
+			items = json.loads(r.text)['_items']
+			return items[0]['count'] if items else 0
+
+		self.assertEqual(count('hour'), 2)
+		self.assertEqual(count('day'), 2)
+
+		r = requests.patch(self.concat('comments/edit/{}'.format(ids[0])),
+			headers={"Authorization": "Basic {}".format(self.user_token)},
+			json={'body': 'without hashtag'})
+		self.assertEqual(count('day'), 1)
+		r = requests.delete(self.concat('comments/edit/{}'.format(ids[1])),
+			headers={"Authorization": "Basic {}".format(self.user_token)})
+		self.assertEqual(count('day'), 0)
+
+		r = requests.get(self.concat('trending?window=year'),
+			headers={"Authorization": "Basic {}".format(self.user_token)})
+		self.assertEqual(r.status_code, 400)
+
+	def test_get_comments_tags_normalized(self):
+		""" tests the hashtag filter ignores the case and matches the whole
+		hashtag unless hashtag_prefix=1.
+		"""
+		tag = 'TestNorm{}'.format(random.randint(1, 100000))
+		self.minimal_comment['body'] += ' #{}'.format(tag)
+		r = requests.post(self.concat('comments/new'),
+			headers={"Authorization": "Basic {}".format(self.user_token)},
+			json=self.minimal_comment)
+		self.assertEqual(r.status_code, 201)
+		self.assertEqual(json.loads(r.text)['hashtags_norm'], [tag.lower()])
+
+		for query, total in [(tag.upper(), 1), (tag[:-1], 0),
+							(tag[:-1] + '&hashtag_prefix=1', 1)]:
+			r = requests.get(self.concat('comments?hashtag=' + query),
+				headers={"Authorization": "Basic {}".format(self.user_token)})
+			data = json.loads(r.text)
+			self.assertEqual(len(data['_items']), total, query)
+
 	def test_edit_comments(self):
 		""" tests edit a comment
 		"""
@@ -766,6 +1129,25 @@ class CommentTestCase(ApiTests):
 		data = json.loads(r.text)
 		self.assertEqual(new_edited_body, data['body'])
 
+	def test_edit_comments_hashtags(self):
+		""" tests if hashtags of an edited comment follow the new body
+		"""
+		r = requests.post(self.concat('comments/new'),
+			headers={"Authorization": "Basic {}".format(self.user_token)},
+			json=self.minimal_comment)
+		data = json.loads(r.text)
+		link = 'comments/edit/{}'.format(data['_id'])
+		self.minimal_comment['body'] = 'Edited with #NewTag'
+		r = requests.patch(self.concat(link),
+			headers={"Authorization": "Basic {}".format(self.user_token)},
+			json=self.minimal_comment)
+		link = 'comments/{}'.format(data['_id'])
+		r = requests.get(self.concat(link),
+			headers={"Authorization": "Basic {}".format(self.user_token)})
+		data = json.loads(r.text)
+		self.assertEqual(data['hashtags'], ['#NewTag'])
+		self.assertEqual(data['hashtags_norm'], ['newtag'])
+
 	def test_edit_comments_change_author(self):
 		""" tests if not changed author
 		"""
@@ -854,7 +1236,23 @@ class CommentTestCase(ApiTests):
 	# DELETE with auth_field is a feature of the Eve.
 
 	def test_set_users_mentioned(self):
-		pass
+		""" tests if mentioned usernames are saved as users _id and unknown
+		usernames are ignored.
+		"""
+		r = requests.post(self.concat('users'),
+			headers={"Authorization": "Basic {}".format(self.super_token)},
+			json=self.data)
+		self.assertEqual(r.status_code, 201)
+		user = json.loads(r.text)
+		username = self.data['email'].split('@')[0].replace('.', '')
+		self.minimal_comment['body'] += " @{} @{} @nobody_{}".format(username,
+			username, random.randint(1, 10000))
+		r = requests.post(self.concat('comments/new'),
+			headers={"Authorization": "Basic {}".format(self.user_token)},
+			json=self.minimal_comment)
+		self.assertEqual(r.status_code, 201)
+		data = json.loads(r.text)
+		self.assertEqual(data['mentions_users'], [user['_id']])
 
 	def test_set_title_with_hashtag(self):
 		""" when creating a comment with hashtag but without issue_id the
@@ -921,6 +1319,42 @@ class CommentTestCase(ApiTests):
 		# title of comment must be equal from register.
 		self.assertEqual(data['title'], issue['title'])
 
+	def test_set_title_with_register_after_update(self):
+		""" tests if the title of comments follows the issue's title updated
+		(issue catalog).
+		"""
+		number = random.randint(1, 10000)
+		issue = {'title': 'SISC ISSUE CATALOG',
+				'body':'Fora',
+				'register': '2015RI/000{}'.format(number + 2),
+				'ugat': 'SUPOP',
+				'ugser': 'SUNAF'
+		}
+		r = requests.post(self.concat('issues'),
+			headers={"Authorization": "Basic {}".format(self.super_token)},
+			json=issue)
+		self.assertEqual(r.status_code, 201)
+		link = 'issues/{}'.format(json.loads(r.text)['_id'])
+
+		del self.minimal_comment['title']
+		self.minimal_comment['register'] = issue['register'].replace('/', '')
+		r = requests.post(self.concat('comments/new'),
+			headers={"Authorization": "Basic {}".format(self.user_token)},
+			json=self.minimal_comment)
+		self.assertEqual(r.status_code, 201)
+		self.assertEqual(json.loads(r.text)['title'], issue['title'])
+
+		r = requests.patch(self.concat(link),
+			headers={"Authorization": "Basic {}".format(self.super_token)},
+			json={'title': 'SISC ISSUE CATALOG UPDATED'})
+		self.assertEqual(r.status_code, 200)
+
+		r = requests.post(self.concat('comments/new'),
+			headers={"Authorization": "Basic {}".format(self.user_token)},
+			json=self.minimal_comment)
+		self.assertEqual(r.status_code, 201)
+		self.assertEqual(json.loads(r.text)['title'], 'SISC ISSUE CATALOG UPDATED')
+
 	def test_post_save(self):
 		pass
 
@@ -928,7 +1362,30 @@ class CommentTestCase(ApiTests):
 		pass
 
 	def test_to_link_mention(self):
-		pass
+		""" tests if mentions of existing users are wrapped by links and
+		e-mails, `@@name` and unknown users aren't.
+		"""
+		r = requests.post(self.concat('users'),
+			headers={"Authorization": "Basic {}".format(self.super_token)},
+			json=self.data)
+		self.assertEqual(r.status_code, 201)
+		user = DATABASE.user.find_one({'_id': ObjectId(json.loads(r.text)['_id'])})
+		username = user['username']
+		self.minimal_comment['body'] += " @{} mail to x@mm.com @@{} " \
+			"@NobodyWithThisName".format(username, username)
+		r = requests.post(self.concat('comments/new'),
+			headers={"Authorization": "Basic {}".format(self.user_token)},
+			json=self.minimal_comment)
+		self.assertEqual(r.status_code, 201)
+		data = json.loads(r.text)
+		link = 'href="/mention/{0}">@{0}</sc-link>'.format(username)
+		self.assertEqual(data['body'].count(link), 1)
+		self.assertIn('@@{}'.format(username), data['body'])
+		self.assertIn(' @NobodyWithThisName', data['body'])
+		self.assertNotIn('/mention/NobodyWithThisName', data['body'])
+		self.assertIn('x@mm.com', data['body'])
+		comment = DATABASE.comment.find_one({'_id': ObjectId(data['_id'])})
+		self.assertEqual(comment['mentions_users'], [user['_id']])
 
 	@unittest.skip(u"This test is useful for webapp. The flow of the Eve skip it.")
 	def test_to_json(self):
@@ -970,6 +1427,79 @@ class StarsTestCase(ApiTests):
 		)
 		self.assertEqual(r.status_code, 201)
 
+	def test_stars_counters(self):
+		""" tests if the comment counts its stars and their scores.
+		"""
+		for score in (2, 3):
+			r = requests.post(self.concat('stars/new'),
+				headers={"Authorization": "Basic {}".format(self.user_token)},
+				json={'comment': self.comment_created['_id'], 'score': score})
+			self.assertEqual(r.status_code, 201)
+		r = requests.get(self.concat('comments/%s' % self.comment_created['_id']),
+			headers={"Authorization": "Basic {}".format(self.user_token)})
+		item = json.loads(r.text)
+		self.assertEqual(item['stars_count'], 2)
+		self.assertEqual(item['stars_score'], 5)
+		self.assertEqual(len(item['stars']), 2)
+
+	def test_leaders(self):
+		""" tests if the stars are counted in the leaderboards.
+		"""
+		r = requests.post(self.concat('stars/new'),
+			headers={"Authorization": "Basic {}".format(self.user_token)},
+			json={'comment': self.comment_created['_id'], 'score': 3})
+		self.assertEqual(r.status_code, 201)
+		for window in ('day', 'week', 'all'):
+			r = requests.get(self.concat('leaders/comments?window={}'.format(window)),
+				headers={"Authorization": "Basic {}".format(self.user_token)})
+			self.assertEqual(r.status_code, 200)
+			items = json.loads(r.text)['_items']
+			leader = [i for i in items
+				if i['comment'] == self.comment_created['_id']][0]
+			self.assertGreaterEqual(leader['stars'], 1)
+			self.assertGreaterEqual(leader['score'], 3)
+		r = requests.get(self.concat('leaders/authors?window=week'),
+			headers={"Authorization": "Basic {}".format(self.user_token)})
+		items = json.loads(r.text)['_items']
+		self.assertIn(self.comment_created['author']['_id'],
+			[i['author'] for i in items])
+		r = requests.get(self.concat('leaders/authors?max_results=1'),
+			headers={"Authorization": "Basic {}".format(self.user_token)})
+		self.assertEqual(len(json.loads(r.text)['_items']), 1)
+		r = requests.get(self.concat('leaders/comments?window=year'),
+			headers={"Authorization": "Basic {}".format(self.user_token)})
+		self.assertEqual(r.status_code, 400)
+
+	def test_embedded_stars_voter(self):
+		""" tests if the stars and their voters are embedded in the comments.
+		"""
+		data_stars = {
+			'comment': self.comment_created['_id'],
+			'score': 2
+		}
+		r = requests.post(self.concat('stars/new'),
+		 	headers={"Authorization": "Basic {}".format(self.user_token)},
+			json=data_stars
+		)
+		self.assertEqual(r.status_code, 201)
+		link = 'comments/%s?embedded={"stars":1,"stars.voter":1}' % \
+			self.comment_created['_id']
+		r = requests.get(self.concat(link),
+			headers={"Authorization": "Basic {}".format(self.user_token)})
+		item = json.loads(r.text)
+		star = item['stars'][-1]
+		self.assertEqual(star['score'], 2)
+		self.assertIn('username', star['voter'])
+		self.assertNotIn('password', star['voter'])
+		self.assertNotIn('token', star['voter'])
+		# the voters only (stars are embedded too)
+		link = 'comments?embedded={"stars.voter":1}'
+		r = requests.get(self.concat(link),
+			headers={"Authorization": "Basic {}".format(self.user_token)})
+		items = json.loads(r.text)['_items']
+		item = [i for i in items if i['_id'] == self.comment_created['_id']][0]
+		self.assertIn('username', item['stars'][-1]['voter'])
+
 
 class InviteTestCase(unittest.TestCase):
 	""" Invite is `yet` a case for `only` webapp. """
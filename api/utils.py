@@ -4,7 +4,9 @@
  Utils.py
 """
 
+import os
 import re
+import sys
 import json
 import hashlib
 import hmac
@@ -14,39 +16,229 @@ import datetime
 import jwt
 import settings
 from bson import ObjectId
+from werkzeug.security import check_password_hash, generate_password_hash
 
 
-def generate_token(user_id):
+def generate_token(user_id, roles=None):
+    """ Returns a HS256 JWT signed with `SECRET_KEY` (and base64 encoded as
+    sent by clients in the basic auth). The claims are enough to authorize a
+    request without the database when `TOKEN_AUTH_STATELESS` is enabled.
+
+    :param user_id: the user's `_id`. It's the `sub` claim.
+    :param roles: the user's roles when the token was issued.
+    """
     secret_key = settings.SECRET_KEY
 
     if not secret_key:
         raise TypeError(u'Environment variable SECRET_KEY is not defined.')
 
+    now = datetime.datetime.utcnow()
     payload = {
         'sub': str(user_id),
-        'iat': datetime.datetime.now()
+        'iat': now,
+        'exp': now + datetime.timedelta(seconds=settings.TOKEN_EXPIRATION),
+        'roles': roles or []
     }
     encoded = jwt.encode(payload, secret_key, algorithm='HS256')
     return base64.b64encode(encoded + ':') #
 
+def decode_token(token):
+    """ Verifies the signature and the claims of a token created by
+    `generate_token` and returns them. Raises `jwt.ExpiredSignatureError` if
+    the token expired and `jwt.InvalidTokenError` for everything else, e.g.
+    tokens issued before the claims `exp` and `roles` existed.
+    """
+    try:
+        encoded = base64.b64decode(token)
+    except (TypeError, ValueError):
+        raise jwt.InvalidTokenError('The token is not base64 encoded.')
+
+    if encoded.endswith(':'):
+        encoded = encoded[:-1]
+
+    claims = jwt.decode(encoded, settings.SECRET_KEY, algorithms=['HS256'])
+    for claim in ('sub', 'iat', 'exp', 'roles'):
+        if claim not in claims:
+            raise jwt.InvalidTokenError('The claim %s is missing.' % claim)
+
+    if not ObjectId.is_valid(claims['sub']):
+        raise jwt.InvalidTokenError('The claim sub is not an user _id.')
+
+    return claims
+
+_hash_pool = None
+_hash_pool_pid = None
+
+def gevent_patched():
+    """ True when running in a gevent worker (see manage.GunicornServer). """
+    if 'gevent' not in sys.modules:
+        return False
+    from gevent import monkey
+    return 'thread' in getattr(monkey, 'saved', {})
+
+def hash_pool():
+    """ Returns the pool of real threads that runs the password hashing. In
+    gevent workers it's the gevent pool so only the calling greenlet waits.
+    It's created per process because threads don't survive a fork.
+    """
+    global _hash_pool, _hash_pool_pid
+
+    if _hash_pool is None or _hash_pool_pid != os.getpid():
+        if gevent_patched():
+            from gevent.threadpool import ThreadPool
+        else:
+            from multiprocessing.pool import ThreadPool
+        _hash_pool = ThreadPool(settings.PASSWORD_HASH_POOL_SIZE)
+        _hash_pool_pid = os.getpid()
+
+    return _hash_pool
+
+def verify_password(pwhash, password):
+    """ `check_password_hash` (PBKDF2) out of the request thread. """
+    return hash_pool().apply(check_password_hash, (pwhash, password))
+
+def hash_passwords(passwords):
+    """ `generate_password_hash` (PBKDF2) of the passwords out of the request
+    thread, in parallel when the pool has more threads.
+    """
+    return hash_pool().map(generate_password_hash, passwords)
+
+def password_digest(password):
+    """ Keyed digest of a password. It's what the login cache keeps instead of
+    the password itself.
+    """
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+    return hmac.new(settings.SECRET_KEY, password, hashlib.sha256).hexdigest()
+
+def username_from_email(email):
+    """ The username of a new user: the local part of the e-mail address
+    without dots.
+    """
+    return email.split('@')[0].replace('.', '')
+
+def md5_email(email):
+    """ `md5_email` of the users, the gravatar's hash of the e-mail. """
+    if isinstance(email, unicode):
+        email = email.encode('utf-8')
+    return hashlib.md5(email).hexdigest()
+
+# Hashtags and @mentions of the comments. A mention can't follow a word char
+# or another `@`, so e-mail addresses and `@@name` aren't mentions.
+MARKUP_PATTERN = re.compile(r'(?P<hashtag>#\w+)|(?<![\w@])@(?P<mention>\w+)',
+                            re.UNICODE)
+
 def to_link_hashtag(hashtag):
-    return '<sc-link class="hashLink" eventname="hashtag-to-search" ' \
+    return u'<sc-link class="hashLink" eventname="hashtag-to-search" ' \
                 'colorlink="#47CACC" href="/hashtag/{value}">{value}' \
                 '</sc-link>'.format(value=hashtag)
 
-def wrap_pattern_by_link(pattern, content):
-    """ Wrap a pattern by a link.
+def to_link_mention(username):
+    return u'<sc-link class="mentionLink" eventname="mention-to-search" ' \
+                'colorlink="#47CACC" href="/mention/{value}">@{value}' \
+                '</sc-link>'.format(value=username)
+
+def scan_markup(content):
+    """ Scans the content once. Returns its pieces, the hashtags (e.g. `#Tag`)
+    and the mentioned usernames (without `@`) in the order they appear. The
+    pieces are text, with the hashtags already wrapped by links, and the
+    mentions as `(username,)`, rendered by join_markup once the mentioned
+    users are known.
+
+    :param content: plaintext to render
+    """
+    pieces = []
+    hashtags = []
+    mentions = []
+    last = 0
+    for match in MARKUP_PATTERN.finditer(content):
+        pieces.append(content[last:match.start()])
+        hashtag = match.group('hashtag')
+        if hashtag:
+            hashtags.append(hashtag)
+            pieces.append(to_link_hashtag(hashtag))
+        else:
+            mentions.append(match.group('mention'))
+            pieces.append((match.group('mention'),))
+        last = match.end()
+    pieces.append(content[last:])
+    return pieces, hashtags, mentions
+
+def join_markup(pieces, users=None):
+    """ Renders the pieces of scan_markup. Only the mentions of `users` (all
+    of them when None) are wrapped by links, the others stay as text.
+    """
+    rendered = []
+    for piece in pieces:
+        if isinstance(piece, tuple):
+            username = piece[0]
+            if users is None or username in users:
+                piece = to_link_mention(username)
+            else:
+                piece = u'@' + username
+        rendered.append(piece)
+    return u''.join(rendered)
+
+def render_markup(content, users=None):
+    """ Wraps hashtags and the mentions of `users` by links (see scan_markup
+    and join_markup). Returns the rendered content, the hashtags and the
+    mentioned usernames.
+    """
+    pieces, hashtags, mentions = scan_markup(content)
+    return join_markup(pieces, users), hashtags, mentions
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def encode_cursor(created_at, _id):
+    """ Opaque cursor of the comments feed (see before_get_comments_after):
+    the `created_at` (in ms) and `_id` of the last comment of a page.
+    """
+    millis = int((created_at.replace(tzinfo=None) - EPOCH).total_seconds() * 1000)
+    value = '%d:%s' % (millis, _id)
+    return base64.urlsafe_b64encode(value).rstrip('=')
 
-    :param pattern: regex pattern to filter
-    :param content: content for parse
+def decode_cursor(cursor):
+    """ Returns the `(created_at, _id)` of a cursor. Raises `ValueError` when
+    it's invalid.
     """
-    filter = re.compile(pattern)
+    try:
+        cursor = str(cursor)
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        millis, _id = value.split(':')
+        created_at = EPOCH + datetime.timedelta(milliseconds=int(millis))
+        return created_at, ObjectId(_id)
+    except Exception:
+        raise ValueError('Invalid cursor %r' % cursor)
 
-    def wrapper(matchobj):
-        if matchobj.group(0):
-            return to_link_hashtag(matchobj.group(0))
+TAG_PATTERN = re.compile(r'<[^>]*>')
+
+def normalize_hashtag(hashtag):
+    """ `#SisComando` -> `siscomando`. It's the form kept in `hashtags_norm`
+    and used by the `?hashtag=` filter.
+    """
+    return hashtag.lstrip('#').lower()
+
+def extract_hashtags(content):
+    """ Hashtags of a content that can already be rendered (the links have
+    `#` within their attributes).
+    """
+    content = TAG_PATTERN.sub(u' ', content)
+    return [m.group('hashtag') for m in MARKUP_PATTERN.finditer(content)
+            if m.group('hashtag')]
 
-    return re.sub(filter, wrapper, content)
+def schema_regexes(schema):
+    """ The `regex` rules of a Cerberus schema, the nested ones included. """
+    for rules in schema.values():
+        if not isinstance(rules, dict):
+            continue
+        if 'regex' in rules:
+            yield rules['regex']
+        nested = rules.get('schema')
+        if isinstance(nested, dict):
+            # the rules of the items of a list or the fields of a dict.
+            nested = {None: nested} if rules.get('type') == 'list' else nested
+            for pattern in schema_regexes(nested):
+                yield pattern
 
 class JSONEncoder(json.JSONEncoder):
     """ Class helper to convert ObjectId to str. This is a
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Views replacing Eve's ones in the hottest endpoints. They keep Eve's
+# authentication, rate limit and rendering (send_response), only the reads
+# are shorter.
+
+import copy
+from eve.auth import auth_field_and_value, requires_auth
+from eve.endpoints import collections_endpoint
+from eve.methods.common import build_response_document, ratelimit
+from eve.render import send_response
+from eve.utils import config
+from flask import abort, current_app as app, request
+# app
+import api
+
+
+@ratelimit()
+@requires_auth('resource')
+def get_me(resource):
+    """ GET /me, called by the webapp on every page. It's the authenticated
+    user read by `_id` (the same as his `owner`) with the projection of `me`,
+    without the pagination and counting of a collection GET. The documents
+    are kept by `api.me_cache` until a PATCH of /me or a login reissuing the
+    token (see hooks.invalidate_me).
+    """
+    _, user_id = auth_field_and_value(resource)
+    if user_id is None:
+        abort(404)
+
+    document = api.me_cache.get(user_id)
+    if document is None:
+        datasource = config.SOURCES[resource]
+        document = app.data.driver.db[datasource['source']].find_one(
+            {config.ID_FIELD: user_id}, datasource['projection'])
+        if document is None:
+            abort(404)
+        build_response_document(document, resource, [])
+        api.me_cache.set(user_id, document)
+
+    document = copy.deepcopy(document)
+    return (document, document[config.LAST_UPDATED],
+            document.get(config.ETAG), 200)
+
+def me_endpoint(**lookup):
+    if request.method in ('GET', 'HEAD'):
+        return send_response('me', get_me('me'))
+    return collections_endpoint(**lookup)
+
+def init_app(app):
+    app.view_functions['me|resource'] = me_endpoint
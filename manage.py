@@ -1,50 +1,130 @@
 # -*- coding: utf-8 -*-
+import copy
+import csv
+import datetime
+import json
+import multiprocessing
+import time
+from bson import ObjectId
 from flask.ext.script import Manager, Server, Command, Option, Shell
+from pymongo.errors import OperationFailure, BulkWriteError
+from werkzeug.local import LocalProxy
 from werkzeug.security import generate_password_hash
+
+
 #APP
-from api import app
+# The app is imported by the commands when they use it, not by this module:
+# `runserver` leaves it to gunicorn (the workers or, with --preload, the
+# master).
+def create_app():
+	from api import app
+	return app
+
+app = LocalProxy(create_app)
+
+
+class LazyManager(Manager):
+	""" Gives the commands the proxy of the app instead of importing it. """
+
+	def __call__(self, *args, **kwargs):
+		return app
 
 
 class GunicornServer(Command):
 	""" This class was based in http://stackoverflow.com/a/14569881/2283488.
+
+	With `workers` 0 it runs 2 * CPUs + 1 workers. Each worker is recycled
+	after `max_requests` (plus up to `max_requests_jitter`, so they don't
+	restart together) to bound its memory and is warmed up after the fork
+	(see api.warmup). The app is imported by each worker or, with `--preload`,
+	once by the master before the fork.
 	"""
 	description = 'Run the app within Gunicorn'
 
-	def __init__(self, host='127.0.0.1', port=9014, workers=4,
-		worker_class='gunicorn.workers.ggevent.GeventWorker'):
+	def __init__(self, host='127.0.0.1', port=9014, workers=0,
+		worker_class='gunicorn.workers.ggevent.GeventWorker',
+		worker_connections=1000, keepalive=5, timeout=30, graceful_timeout=30,
+		max_requests=10000, max_requests_jitter=1000):
 		self.port = port
 		self.host = host
 		self.workers = workers
 		self.worker_class = worker_class
+		self.worker_connections = worker_connections
+		self.keepalive = keepalive
+		self.timeout = timeout
+		self.graceful_timeout = graceful_timeout
+		self.max_requests = max_requests
+		self.max_requests_jitter = max_requests_jitter
 
 	def get_options(self):
 		return (
 			Option('-H', '--host', dest='host', default=self.host),
 			Option('-p', '--port', type=int, default=self.port),
-			Option('-w', '--workers', type=int, default=self.workers),
+			Option('-w', '--workers', type=int, default=self.workers,
+				help='0 runs 2 * CPUs + 1 workers'),
 			Option('-wc', '--worker-class', dest='worker_class', default=self.worker_class),
+			Option('--worker-connections', dest='worker_connections', type=int,
+				default=self.worker_connections,
+				help='simultaneous clients of each gevent worker'),
+			Option('--keepalive', type=int, default=self.keepalive,
+				help='seconds to wait for requests on a keep-alive connection'),
+			Option('-t', '--timeout', type=int, default=self.timeout),
+			Option('--graceful-timeout', dest='graceful_timeout', type=int,
+				default=self.graceful_timeout),
+			Option('--max-requests', dest='max_requests', type=int,
+				default=self.max_requests, help='0 never recycles the workers'),
+			Option('--max-requests-jitter', dest='max_requests_jitter', type=int,
+				default=self.max_requests_jitter),
+			Option('--preload', dest='preload', action='store_true', default=False),
+			Option('--no-warmup', dest='warmup', action='store_false', default=True),
 		)
 
-	def __call__(self, app, host, port, workers, worker_class):
+	def __call__(self, app, host, port, workers, worker_class,
+		worker_connections, keepalive, timeout, graceful_timeout, max_requests,
+		max_requests_jitter, preload, warmup):
 		from gunicorn.app.base import Application
 
+		def post_fork(server, worker):
+			import api
+			try:
+				api.warmup()
+			except Exception:
+				# the worker still serves, its first requests are just slower.
+				worker.log.exception('Warm-up of worker %s failed', worker.pid)
+
 		class FlaskApplication(Application):
 			def init(self, parser, opts, args):
 				""" This configures the Application class from gunicorn.
 				"""
-				return {
+				config = {
 					'bind': '{0}:{1}'.format(host, port),
-					'workers': workers,
+					'workers': workers or multiprocessing.cpu_count() * 2 + 1,
 					'worker_class': worker_class,
+					'worker_connections': worker_connections,
+					'keepalive': keepalive,
+					'timeout': timeout,
+					'graceful_timeout': graceful_timeout,
+					'max_requests': max_requests,
+					'max_requests_jitter': max_requests_jitter,
+					'preload_app': preload,
 				}
+				if warmup:
+					config['post_fork'] = post_fork
+				return config
+
+			def load_config(self):
+				# the options were parsed by Flask-Script. gunicorn's parser
+				# would parse them again (and override `workers` 0).
+				for key, value in self.init(None, None, None).items():
+					self.cfg.set(key, value)
 
 			def load(self):
-				return app
+				return create_app()
 
 		FlaskApplication().run()
 
 
-manager = Manager(app)
+manager = LazyManager()
 
 @manager.command
 def addsuperuser():
@@ -54,6 +134,520 @@ def addsuperuser():
 					'roles': ['superusers']})
 	print "The s@super.com:123 was created. You can change it later."
 
+def plan_stages(plan):
+	""" Yields the stages (and old style cursors) of an explain() output. """
+	if isinstance(plan, dict):
+		if 'stage' in plan:
+			yield plan['stage']
+		if isinstance(plan.get('cursor'), basestring): # MongoDB < 3.0
+			yield plan['cursor'].split(' ')[0]
+		for value in plan.values():
+			for stage in plan_stages(value):
+				yield stage
+	elif isinstance(plan, list):
+		for value in plan:
+			for stage in plan_stages(value):
+				yield stage
+
+# MongoDB's error of an index created again with other options.
+INDEX_OPTIONS_CONFLICT = 85
+
+def duplicated_keys(collection, keys, sparse=False, limit=10):
+	""" Up to `limit` values of the index `keys` held by more than one
+	document, i.e. the ones that prevent a unique index.
+	"""
+	fields = [field for field, _ in keys]
+	pipeline = []
+	if sparse:
+		pipeline.append({'$match': {'$or': [{field: {'$exists': True}}
+											for field in fields]}})
+	pipeline += [
+		{'$group': {'_id': dict(('k%d' % i, '$' + field)
+								for i, field in enumerate(fields)),
+					'count': {'$sum': 1}}},
+		{'$match': {'count': {'$gt': 1}}},
+		{'$limit': limit},
+	]
+	result = collection.aggregate(pipeline, cursor={}, allowDiskUse=True)
+	return [tuple(group['_id'].get('k%d' % i) for i in range(len(fields)))
+			for group in result]
+
+def rebuild_index(collection, keys, options):
+	""" Drops the index of `keys` and builds it with `options`. If the build
+	fails (e.g. a duplicate written meanwhile) the old index is built again,
+	so the collection isn't left without it.
+	"""
+	old = [dict(info, name=index_name) for index_name, info
+			in collection.index_information().items()
+			if info['key'] == list(keys)]
+	collection.drop_index(keys)
+	try:
+		return collection.create_index(keys, **options)
+	except OperationFailure:
+		for info in old:
+			collection.create_index(keys, **dict((k, v) for k, v in info.items()
+											if k not in ('key', 'v', 'ns')))
+		raise
+
+@manager.command
+def ensureindexes(collection=None):
+	""" Builds in background the indexes declared in resources.INDEXES and
+	explains their queries reporting the ones that still scan the collection.
+	"""
+	from api.resources import INDEXES
+	db = app.data.driver.db
+	collscans = 0
+	for name, indexes in sorted(INDEXES.items()):
+		if collection and name != collection:
+			continue
+
+		for index in indexes:
+			options = dict(index.get('options', {}), background=True)
+			try:
+				try:
+					index_name = db[name].create_index(index['keys'], **options)
+				except OperationFailure as e:
+					if e.code != INDEX_OPTIONS_CONFLICT:
+						raise
+					# the same keys with other options (e.g. now unique). The
+					# current index is kept while there are duplicates.
+					if options.get('unique'):
+						duplicates = duplicated_keys(db[name], index['keys'],
+													options.get('sparse'))
+						if duplicates:
+							print "%s: %s not rebuilt, duplicated values: %s" % (
+								name, index['keys'], duplicates)
+							continue
+					index_name = rebuild_index(db[name], index['keys'], options)
+				print "%s: %s ok" % (name, index_name)
+			except OperationFailure as e:
+				# e.g. duplicated values for a unique index.
+				print "%s: %s failed: %s" % (name, index['keys'], e)
+
+		for index in indexes:
+			for query in index.get('queries', []):
+				cursor = db[name].find(query['lookup']).limit(1)
+				if query.get('sort'):
+					cursor = cursor.sort(query['sort'])
+				stages = set(plan_stages(cursor.explain()))
+				if 'COLLSCAN' in stages or 'BasicCursor' in stages:
+					collscans += 1
+					print "%s: COLLSCAN %s" % (name, query)
+
+	print "%d quer(ies) doing COLLSCAN." % collscans
+
+def read_rows(path, format):
+	""" Yields `(line, row)` of a CSV (with header) or NDJSON file without
+	loading it. The rows of NDJSON are the JSON text.
+	"""
+	with open(path, 'rb') as f:
+		if format == 'csv':
+			for line, row in enumerate(csv.DictReader(f), 2):
+				yield line, dict((k.decode('utf-8'), v.decode('utf-8'))
+								for k, v in row.items() if v != '')
+		else:
+			for line, row in enumerate(f, 1):
+				if row.strip():
+					yield line, row
+
+def coerce_csv(row, schema):
+	""" CSV values are text. Converts them to the type of the schema. """
+	for field, value in row.items():
+		kind = schema.get(field, {}).get('type')
+		if kind == 'integer':
+			row[field] = int(value)
+		elif kind == 'boolean':
+			row[field] = value.lower() in ('1', 'true', 'yes', 'sim')
+		elif kind == 'list':
+			row[field] = [v.strip() for v in value.split(';') if v.strip()]
+	return row
+
+def parse_row(row, format, schema):
+	""" The document of a row of read_rows. Raises ValueError. """
+	if format == 'csv':
+		return coerce_csv(row, schema)
+	row = json.loads(row)
+	if not isinstance(row, dict):
+		raise ValueError('not a JSON object')
+	return row
+
+def chunks(iterable, size):
+	chunk = []
+	for item in iterable:
+		chunk.append(item)
+		if len(chunk) == size:
+			yield chunk
+			chunk = []
+	if chunk:
+		yield chunk
+
+@manager.option('path', help='CSV (with header) or NDJSON file')
+@manager.option('-f', '--format', dest='format', choices=['csv', 'ndjson'],
+				default=None, help='default: by the extension of the file')
+@manager.option('-b', '--batch', dest='batch', type=int, default=1000)
+def importissues(path, format=None, batch=1000):
+	""" Imports (or updates by `register`) issues from a CSV or NDJSON file.
+	The rows are validated by the issues schema and normalized as the POSTs
+	are, then written by batches of unordered upserts.
+	"""
+	import api
+	from api.schemas import issues_schema
+	from api.hooks import (before_on_insert_issue, invalidate_grouped_issues,
+		update_issue_stats, ISSUE_STATS_FIELDS)
+	format = format or ('csv' if path.lower().endswith('.csv') else 'ndjson')
+	# `unique` costs one query per document. The upserts by register (and its
+	# unique index, for concurrent writers) replace it.
+	schema = copy.deepcopy(issues_schema)
+	for rules in schema.values():
+		rules.pop('unique', None)
+	validator = app.validator(schema, 'issues')
+	defaults = app.config['DOMAIN']['issues']['defaults']
+	issues = app.data.driver.db['issue']
+
+	start = time.time()
+	total = inserted = updated = 0
+	rejects = []
+	for rows in chunks(read_rows(path, format), batch):
+		docs = []
+		lines = []
+		for line, row in rows:
+			total += 1
+			try:
+				row = parse_row(row, format, schema)
+			except ValueError as e:
+				rejects.append((line, str(e)))
+				continue
+			if validator.validate(row):
+				docs.append(row)
+				lines.append(line)
+			else:
+				rejects.append((line, validator.errors))
+		if not docs:
+			continue
+
+		before_on_insert_issue(docs)
+		# the issues as they were, to move their counters in issue_stats.
+		lookup = {'register': {'$in': [doc['register'] for doc in docs]}}
+		current = dict((issue['register'], issue)
+						for issue in issues.find(lookup, ISSUE_STATS_FIELDS + ('register',)))
+		now = datetime.datetime.utcnow()
+		bulk = issues.initialize_unordered_bulk_op()
+		inserts = []
+		for doc in docs:
+			doc['updated_at'] = now
+			on_insert = dict((k, v) for k, v in defaults.items() if k not in doc)
+			on_insert['created_at'] = now
+			inserts.append(on_insert)
+			bulk.find({'register': doc['register']}).upsert().update_one(
+				{'$set': doc, '$setOnInsert': on_insert})
+		failed = set()
+		try:
+			result = bulk.execute()
+		except BulkWriteError as e:
+			result = e.details
+			for error in result['writeErrors']:
+				failed.add(error['index'])
+				rejects.append((lines[error['index']], error['errmsg']))
+		inserted += result['nUpserted']
+		updated += result['nMatched']
+
+		changes = []
+		for index, (doc, on_insert) in enumerate(zip(docs, inserts)):
+			api.issue_catalog.delete(doc['register'])
+			if index in failed:
+				continue
+			original = current.get(doc['register'])
+			issue = dict(original or on_insert, **doc)
+			if original:
+				changes.append((original, -1))
+			changes.append((issue, 1))
+			current[doc['register']] = issue
+		update_issue_stats(changes)
+		invalidate_grouped_issues(*[issue for issue, _ in changes])
+
+		elapsed = time.time() - start
+		print "%d row(s), %d inserted, %d updated, %d rejected, %.0f rows/s" % (
+			total, inserted, updated, len(rejects), total / elapsed)
+
+	for line, errors in rejects:
+		print "rejected line %d: %s" % (line, errors)
+	elapsed = time.time() - start
+	print "%d row(s) in %.1fs (%.0f rows/s): %d inserted, %d updated, " \
+		"%d rejected." % (total, elapsed, total / elapsed if elapsed else 0,
+						inserted, updated, len(rejects))
+
+@manager.option('path', help='CSV (with header) or NDJSON file')
+@manager.option('-f', '--format', dest='format', choices=['csv', 'ndjson'],
+				default=None, help='default: by the extension of the file')
+@manager.option('-b', '--batch', dest='batch', type=int, default=500)
+@manager.option('-p', '--processes', dest='processes', type=int, default=None,
+				help='password hashing processes (default: CPUs)')
+def importusers(path, format=None, batch=500, processes=None):
+	""" Creates users from a CSV or NDJSON file (`email`, `password` and
+	optionally names, `location`, `avatar` and `roles`, `;` separated in CSV).
+	The users are completed as POST /users does (username, password hash,
+	token, owner, md5_email) and written by batches of unordered inserts. The
+	passwords are hashed by a pool of processes. Users whose e-mail or
+	username already exist are skipped as duplicates.
+	"""
+	from api.schemas import users_schema
+	from api.utils import generate_token, username_from_email, md5_email
+	format = format or ('csv' if path.lower().endswith('.csv') else 'ndjson')
+	# `unique` costs one query per document. One `$in` per batch replaces it.
+	schema = copy.deepcopy(users_schema)
+	for rules in schema.values():
+		rules.pop('unique', None)
+	validator = app.validator(schema, 'users')
+	defaults = app.config['DOMAIN']['users']['defaults']
+	users = app.data.driver.db['user']
+	pool = multiprocessing.Pool(processes)
+
+	start = time.time()
+	hashing = 0.0
+	total = inserted = hashed = 0
+	rejects = []
+	duplicates = []
+	seen = set()
+	try:
+		for rows in chunks(read_rows(path, format), batch):
+			docs = []
+			lines = []
+			for line, row in rows:
+				total += 1
+				try:
+					row = parse_row(row, format, schema)
+				except ValueError as e:
+					rejects.append((line, str(e)))
+					continue
+				if not validator.validate(row):
+					rejects.append((line, validator.errors))
+					continue
+				row['username'] = username_from_email(row['email'])
+				keys = (row['email'], row['username'])
+				if seen.intersection(keys):
+					duplicates.append((line, row['email']))
+					continue
+				seen.update(keys)
+				docs.append(row)
+				lines.append(line)
+			if not docs:
+				continue
+
+			lookup = {'$or': [
+				{'email': {'$in': [doc['email'] for doc in docs]}},
+				{'username': {'$in': [doc['username'] for doc in docs]}}]}
+			existing = set()
+			for user in users.find(lookup, {'email': 1, 'username': 1}):
+				existing.update([user.get('email'), user.get('username')])
+			news = []
+			for line, doc in zip(lines, docs):
+				if doc['email'] in existing or doc['username'] in existing:
+					duplicates.append((line, doc['email']))
+				else:
+					news.append((line, doc))
+			if not news:
+				continue
+
+			hash_start = time.time()
+			passwords = pool.map(generate_password_hash,
+								[doc['password'] for _, doc in news])
+			hashing += time.time() - hash_start
+			hashed += len(passwords)
+
+			now = datetime.datetime.utcnow()
+			bulk = users.initialize_unordered_bulk_op()
+			for (_, doc), password in zip(news, passwords):
+				for field, value in defaults.items():
+					doc.setdefault(field, copy.deepcopy(value))
+				doc['_id'] = ObjectId()
+				doc['owner'] = doc['_id']
+				doc['password'] = password
+				doc['md5_email'] = md5_email(doc['email'])
+				doc['token'] = generate_token(doc['_id'], doc.get('roles'))
+				doc['username_lower'] = doc['username'].lower()
+				doc['created_at'] = doc['updated_at'] = now
+				bulk.insert(doc)
+			try:
+				result = bulk.execute()
+			except BulkWriteError as e:
+				# created meanwhile (unique indexes of resources.INDEXES).
+				result = e.details
+				for error in result['writeErrors']:
+					line, doc = news[error['index']]
+					if error.get('code') == 11000:
+						duplicates.append((line, doc['email']))
+					else:
+						rejects.append((line, error['errmsg']))
+			inserted += result['nInserted']
+
+			elapsed = time.time() - start
+			print "%d row(s), %d inserted, %d duplicated, %d rejected, " \
+				"%.0f rows/s" % (total, inserted, len(duplicates), len(rejects),
+								total / elapsed)
+	finally:
+		pool.close()
+		pool.join()
+
+	for line, email in duplicates:
+		print "duplicated line %d: %s" % (line, email)
+	for line, errors in rejects:
+		print "rejected line %d: %s" % (line, errors)
+	elapsed = time.time() - start
+	print "%d row(s) in %.1fs (%.0f rows/s, %.0f hashes/s): %d inserted, " \
+		"%d duplicated, %d rejected." % (total, elapsed,
+		total / elapsed if elapsed else 0,
+		hashed / hashing if hashing else 0, inserted, len(duplicates),
+		len(rejects))
+
+@manager.option('-b', '--batch', dest='batch', type=int, default=1000)
+def rebuildissuestats(batch=1000):
+	""" Rebuilds `issue_stats` from all issues. It's built aside and replaces
+	the current one at the end. Issues changed meanwhile aren't counted, so run
+	it when the API is idle.
+	"""
+	from api.hooks import update_issue_stats, ISSUE_STATS_FIELDS
+	db = app.data.driver.db
+	building = db['issue_stats_rebuild']
+	building.drop()
+	building.create_index([('unit_type', 1), ('unit', 1)], unique=True)
+	total = 0
+	last_id = None
+	while True:
+		lookup = {'_id': {'$gt': last_id}} if last_id else {}
+		docs = list(db['issue'].find(lookup, ISSUE_STATS_FIELDS)
+					.sort('_id', 1).limit(batch))
+		if not docs:
+			break
+		last_id = docs[-1]['_id']
+		update_issue_stats([(doc, 1) for doc in docs], building)
+		total += len(docs)
+		print "%d issue(s) counted." % total
+	if total:
+		building.rename('issue_stats', dropTarget=True)
+	else:
+		db['issue_stats'].drop()
+	print "issue_stats rebuilt from %d issue(s)." % total
+
+@manager.command
+def resetcatalog():
+	""" Starts a new generation of the issue catalog, so every worker empties
+	its file within ISSUE_CATALOG_SYNC seconds. Run it after restoring the
+	database from a backup.
+	"""
+	db = app.data.driver.db
+	db['cache_versions'].update({'_id': 'issue_catalog'},
+								{'$set': {'generation': ObjectId()}}, upsert=True)
+	print "The issue catalog will be emptied by the workers."
+
+# `backfill <field>` migrates the existing documents to a new field.
+backfill = LazyManager(usage='Fills new fields of the existing documents')
+
+def backfill_batches(collection, field, fields, batch):
+	""" Yields the documents without `field` (all of them when `field` is
+	None) in batches of `batch`, walking the `_id` index so every batch is a
+	range read.
+	"""
+	lookup = {field: {'$exists': False}} if field else {}
+	last_id = None
+	while True:
+		if last_id:
+			lookup['_id'] = {'$gt': last_id}
+		docs = list(collection.find(lookup, fields).sort('_id', 1).limit(batch))
+		if not docs:
+			break
+		last_id = docs[-1]['_id']
+		yield docs
+
+@backfill.option('-b', '--batch', dest='batch', type=int, default=1000)
+def hashtags(batch=1000):
+	""" Sets `hashtags_norm` of the comments created before it existed. """
+	from api.hooks import unique_hashtags_norm
+	comments = app.data.driver.db['comment']
+	total = 0
+	for docs in backfill_batches(comments, 'hashtags_norm', {'hashtags': 1},
+								batch):
+		bulk = comments.initialize_unordered_bulk_op()
+		for doc in docs:
+			norms = unique_hashtags_norm(doc.get('hashtags') or [])
+			bulk.find({'_id': doc['_id']}).update_one(
+				{'$set': {'hashtags_norm': norms}})
+		bulk.execute()
+		total += len(docs)
+		print "%d comment(s) migrated." % total
+
+@backfill.option('-b', '--batch', dest='batch', type=int, default=1000)
+def usernames(batch=1000):
+	""" Sets `username_lower` (autocomplete) of the users created before it
+	existed.
+	"""
+	users = app.data.driver.db['user']
+	total = 0
+	for docs in backfill_batches(users, 'username_lower', {'username': 1},
+								batch):
+		bulk = users.initialize_unordered_bulk_op()
+		for doc in docs:
+			# users without username get '' so they aren't selected again.
+			bulk.find({'_id': doc['_id']}).update_one(
+				{'$set': {'username_lower': (doc.get('username') or '').lower()}})
+		bulk.execute()
+		total += len(docs)
+		print "%d user(s) migrated." % total
+
+@backfill.option('-b', '--batch', dest='batch', type=int, default=1000)
+@backfill.option('-n', '--dry-run', dest='dry_run', action='store_true',
+				default=False, help='only report the wrong counters')
+def stars(batch=1000, dry_run=False):
+	""" Recomputes `stars_count`, `stars_score` and the latest `stars` of all
+	comments from the stars collection and fixes the ones that differ. The
+	values are absolute, so it can run again at any time. Votes made while a
+	batch is fixed can be missed by it: run it when the API is idle or again.
+	With --dry-run it only reports the comments whose counters differ and
+	exits with 1 when there's any.
+	"""
+	import api
+	db = app.data.driver.db
+	comments = db['comment']
+	limit = api.settings.STARS_EMBEDDED_MAX
+	fields = {'stars_count': 1, 'stars_score': 1, 'stars': 1}
+	total = 0
+	wrong = 0
+	for docs in backfill_batches(comments, None, fields, batch):
+		ids = [doc['_id'] for doc in docs]
+		result = db['stars'].aggregate([
+			{'$match': {'comment': {'$in': ids}}},
+			{'$sort': {'created_at': 1, '_id': 1}},
+			{'$group': {'_id': '$comment', 'count': {'$sum': 1},
+						'score': {'$sum': '$score'}, 'stars': {'$push': '$_id'}}}
+		], cursor={})
+		votes = dict((vote['_id'], vote) for vote in result)
+		bulk = comments.initialize_unordered_bulk_op()
+		changed = 0
+		for doc in docs:
+			vote = votes.get(doc['_id'], {})
+			counters = {
+				'stars_count': vote.get('count', 0),
+				'stars_score': vote.get('score', 0),
+				'stars': vote.get('stars', [])[-limit:]}
+			if all(doc.get(key) == value for key, value in counters.items()):
+				continue
+			changed += 1
+			if dry_run:
+				print "comment %s: %s, expected %s" % (doc['_id'],
+					dict((key, doc.get(key)) for key in ('stars_count', 'stars_score')),
+					dict((key, counters[key]) for key in ('stars_count', 'stars_score')))
+			else:
+				bulk.find({'_id': doc['_id']}).update_one({'$set': counters})
+		if changed and not dry_run:
+			bulk.execute()
+		total += len(docs)
+		wrong += changed
+		print "%d comment(s) checked, %d %s." % (total, wrong,
+			'wrong' if dry_run else 'fixed')
+	if dry_run and wrong:
+		return 1
+
+manager.add_command('backfill', backfill)
+
 # `runserver_sync` runs the server as develop mode from flask.
 manager.add_command('runserver_sync', Server(host='127.0.0.1', port=9014))
 # `runserver` runs the server of the WebApp for production behavior.